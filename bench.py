@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Benchmark suite.  Generates a synthetic journal, split over a number of
+# included files, and times loading it and the common queries against
+# it.  Results are written as JSON so runs from different commits can be
+# compared:
+#
+#   python bench.py --transactions 100000 -o before.json
+#   python bench.py --transactions 100000 -o after.json --compare before.json
+#
+# The suite also includes the parser throughput benchmark, which parses a
+# single file journal of --lines lines from throughput_journal() and
+# reports lines per second.  Its defaults give the same journal as the
+# original one-off benchmark, so those numbers stay comparable.  Pass
+# --lines 0 to skip it.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import uledger
+import web
+
+ORGS = ["Personal", "Business"]
+CATEGORIES = ["Assets", "Liabilities", "Expenses", "Income", "Equity"]
+
+# Journal shape.  outoforder is the fraction of transactions dated
+# before the ones around them, asserts the fraction followed by a
+# balance assertion
+DEFAULTS = {
+    "transactions": 20000,
+    "accounts": 50,
+    "commodities": 3,
+    "includes": 4,
+    "outoforder": 0.05,
+    "asserts": 0.01,
+    "seed": 0,
+}
+
+def account_names(count):
+    return ["%s:%s:Account%d" % (ORGS[i % len(ORGS)], CATEGORIES[i // len(ORGS) % len(CATEGORIES)], i) for i in range(count)]
+
+def commodity_names(count):
+    names = ["$"]
+    while len(names) < count:
+        i = len(names)
+        names.append("C" + chr(ord("A") + i // 26 % 26) + chr(ord("A") + i % 26))
+    return names
+
+def amount(commodity, cents):
+    sign = "-" if cents < 0 else ""
+    if commodity == "$":
+        return "$%s%d.%02d" % (sign, abs(cents) // 100, abs(cents) % 100)
+    return "%s%d.%02d %s" % (sign, abs(cents) // 100, abs(cents) % 100, commodity)
+
+# Writes main.ledger, which includes the others, into directory and
+# returns its path.  Each assertion is dated before every transaction
+# that follows it, so it holds whether or not assertions are deferred
+def generate(directory, transactions, accounts, commodities, includes, outoforder, asserts, seed):
+    rand = random.Random(seed)
+    accounts = account_names(accounts)
+    commodities = commodity_names(commodities)
+    start = datetime.date(2005, 1, 1)
+
+    days = []
+    for i in range(transactions):
+        day = i * 3650 // transactions
+        if rand.random() < outoforder:
+            day = rand.randint(0, day)
+        days.append(day)
+    # Earliest day of the transactions after each one
+    later = [3650] * transactions
+    for i in range(transactions - 2, -1, -1):
+        later[i] = min(days[i + 1], later[i + 1])
+
+    # account -> [(day, cents)] of its $ posts
+    posts = dict((account, []) for account in accounts)
+
+    # With no includes, the transactions go in main.ledger itself
+    main = os.path.join(directory, "main.ledger")
+    parts = [os.path.join(directory, "part%d.ledger" % n) for n in range(includes)] or [main]
+    with open(main, "w") as f:
+        f.write("; Synthetic journal generated by bench.py\n")
+        f.write("alias cash %s\n" % accounts[0])
+        for part in parts:
+            if part != main:
+                f.write("include %s\n" % part)
+
+    written = 0
+    for n, part in enumerate(parts):
+        count = transactions // len(parts) if n < len(parts) - 1 else transactions - written
+        with open(part, "a") as f:
+            for i in range(written, written + count):
+                date = start + datetime.timedelta(days=days[i])
+                commodity = rand.choice(commodities)
+                f.write("%s Transaction %d\n" % (date.isoformat(), i))
+                total = 0
+                for j in range(rand.randint(1, 2)):
+                    account = rand.choice(accounts)
+                    cents = rand.randint(-50000, 50000)
+                    f.write("    %s  %s\n" % ("cash" if account == accounts[0] else account, amount(commodity, cents)))
+                    if commodity == "$":
+                        posts[account].append((days[i], cents))
+                    total += cents
+                account = rand.choice(accounts)
+                f.write("    %s\n\n" % account)
+                if commodity == "$":
+                    posts[account].append((days[i], -total))
+
+                if rand.random() < asserts and later[i] > 0:
+                    account = rand.choice(accounts)
+                    asof = later[i] - 1
+                    cents = sum(cents for (day, cents) in posts[account] if day <= asof)
+                    f.write("assert balance %s %s  %s\n\n" % ((start + datetime.timedelta(days=asof)).isoformat(), account, amount("$", cents)))
+        written += count
+    return main
+
+ACCOUNTS = [
+    "Personal:Assets:Checking",
+    "Personal:Assets:Savings",
+    "Personal:Liabilities:VISA",
+    "Personal:Expenses:Groceries",
+    "Personal:Expenses:Rent",
+    "Personal:Expenses:Vehicle",
+    "Personal:Expenses:Office",
+    "Personal:Income:Day Job",
+    "Business:Assets:Bank",
+    "Business:Income:Consulting",
+    "Business:Expenses:Parts",
+]
+
+# Writes a journal of about lines lines to f for the throughput
+# benchmark, with comments, an alias, a bucket, a second commodity and
+# amount expressions
+def throughput_journal(f, lines, seed=0):
+    rand = random.Random(seed)
+    start = datetime.date(2005, 1, 1)
+    written = 0
+    f.write("; Synthetic journal generated by bench.py\n")
+    f.write("alias groceries Personal:Expenses:Groceries\n")
+    f.write("bucket Personal:Assets:Checking\n")
+    written += 3
+    while written < lines:
+        date = start + datetime.timedelta(days=rand.randint(0, 3650))
+        f.write("%s Transaction %d\n" % (date.isoformat(), written))
+        f.write("    ; imported\n")
+        for i in range(rand.randint(1, 3)):
+            account = rand.choice(ACCOUNTS + ["groceries"])
+            if rand.random() < 0.05:
+                f.write("    %s  %.2f CAD\n" % (account, rand.uniform(-500, 500)))
+            elif rand.random() < 0.05:
+                f.write("    %s  ($%.2f * 1.06)\n" % (account, rand.uniform(1, 500)))
+            else:
+                f.write("    %s  $%.2f\n" % (account, rand.uniform(-500, 500)))
+            written += 1
+        f.write("\n")
+        written += 3
+
+# Returns the number of lines in a throughput journal and the best time
+# of repeat runs of Ledger.parse over it
+def throughput(lines, seed, repeat):
+    fd, filename = tempfile.mkstemp(suffix=".ledger")
+    try:
+        with os.fdopen(fd, "w") as f:
+            throughput_journal(f, lines, seed)
+        with open(filename) as f:
+            count = sum(1 for line in f)
+        def parse():
+            with open(filename) as f:
+                uledger.Ledger().parse(f, filename)
+        return count, best(parse, repeat)
+    finally:
+        os.unlink(filename)
+
+def best(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+# Returns {benchmark: seconds}, the best of repeat runs of each
+def run(filename, repeat=3):
+    results = {}
+    loaded = []
+    def parse():
+        ledger = uledger.Ledger()
+        ledger.load(filename)
+        loaded[:] = [ledger]
+    results["parse"] = best(parse, repeat)
+    ledger = loaded[0]
+
+    accounts = sorted(ledger.accounts)
+    first, last = [datetime.datetime.strptime(date, "%Y-%m-%d") for date in (ledger.startdate(), ledger.enddate())]
+    middle = (first + (last - first) // 2).strftime("%Y-%m-%d")
+    prefixes = sorted(set(":".join(account.split(":")[:depth]) for account in accounts for depth in (1, 2)))
+
+    results["balance"] = best(lambda: [ledger.balance(account, middle) for account in accounts], repeat)
+    results["balances"] = best(lambda: ledger.balances(), repeat)
+    results["balance_children"] = best(lambda: [ledger.balance_children(prefix, middle) for prefix in prefixes], repeat)
+    results["register"] = best(lambda: list(ledger.register()), repeat)
+
+    destdir = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        sys.stdout = open(os.devnull, "w")
+        results["make_report"] = best(lambda: web.make_report(ledger, destdir), repeat)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(destdir)
+    return results
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark parsing and queries')
+    parser.add_argument('-f','--filename', help='benchmark this journal instead of generating one')
+    for name, value in sorted(DEFAULTS.items()):
+        parser.add_argument('--' + name, type=type(value), default=value, help='default %s' % value)
+    parser.add_argument('-l','--lines', type=int, default=1000000, help='size of the throughput benchmark journal, default 1000000')
+    parser.add_argument('-r','--repeat', type=int, default=3, help='report the best of this many runs')
+    parser.add_argument('-o','--output', help='write results to this file as JSON')
+    parser.add_argument('--compare', help='show the change from results saved by an earlier run')
+    args = parser.parse_args()
+
+    params = dict((name, getattr(args, name)) for name in DEFAULTS)
+    directory = None
+    filename = args.filename
+    if filename is None:
+        directory = tempfile.mkdtemp()
+        filename = generate(directory, **params)
+    else:
+        params = {"filename": filename}
+
+    try:
+        results = run(filename, args.repeat)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    if args.lines > 0:
+        params["lines"] = args.lines
+        lines, seconds = throughput(args.lines, args.seed, args.repeat)
+        results["parse_throughput"] = seconds
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+
+    for name, seconds in sorted(results.items()):
+        line = "%-20s %10.4fs" % (name, seconds)
+        if previous is not None and previous.get(name):
+            line += " %+7.1f%%" % ((seconds / previous[name] - 1) * 100)
+        print line
+    if "parse_throughput" in results:
+        seconds = results["parse_throughput"]
+        print "%d lines in %.2fs: %d lines/second" % (lines, seconds, lines / seconds)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"revision": revision(), "python": sys.version.split()[0], "params": params, "results": results}, f, indent=2, sort_keys=True)
@@ -0,0 +1,130 @@
+import BaseHTTPServer
+import json
+import sys
+import time
+import urlparse
+
+import web
+
+# Serves queries against a ledger that stays loaded between requests.
+# Every response is JSON, with amounts as strings so they keep their
+# exact Decimal value:
+#
+#   /balance?asof=D                    every account's balance
+#   /balance?account=A&asof=D          one account's balance
+#   /balance?account=A&children=1      A and its sub-accounts combined
+#   /register?account=A&start=D&end=D  register rows, as the CLI prints
+#   /report?year=Y                     year end balances and rollups, as
+#                                      used by web.make_report
+#
+# Before answering, the journal and its includes are checked for changes
+# at most once every interval seconds and appended text is applied with
+# Ledger.refresh().
+
+def amounts(balance):
+    return dict((commodity, str(value)) for (commodity, value) in balance.items())
+
+class LedgerServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, address, ledger, interval=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, LedgerHandler)
+        self.ledger = ledger
+        # The module the ledger's exceptions come from.  Started as
+        # uledger.py serve, that is __main__ rather than uledger
+        self.errors = sys.modules[type(ledger).__module__]
+        self.interval = interval
+        self.checked = time.time()
+        # Set when a refresh failed part way, so the next check reloads
+        # from scratch rather than trusting what was applied
+        self.stale = False
+
+    # Picks up changes to the journal files.  Raises the parse or
+    # assertion error if the journal no longer loads
+    def check(self):
+        now = time.time()
+        if not self.stale and now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            if self.stale:
+                self.ledger.reload()
+            else:
+                self.ledger.refresh()
+        except:
+            self.stale = True
+            raise
+        self.stale = False
+
+    def balance(self, query):
+        ledger = self.ledger
+        asof = query.get("asof")
+        if "account" not in query:
+            return dict((account, amounts(balance)) for (account, balance) in ledger.balances(asof).items())
+        if query.get("children"):
+            return amounts(ledger.balance_children(query["account"], asof))
+        return amounts(ledger.balance(query["account"], asof))
+
+    def register(self, query):
+        rows = self.ledger.register(query.get("account"), query.get("start"), query.get("end"))
+        return [dict(row._asdict(), value=str(row.value), balance=str(row.balance)) for row in rows]
+
+    def report(self, query):
+        ledger = self.ledger
+        if len(ledger.store) == 0:
+            return {}
+        firstyear = int(ledger.startdate()[:4])
+        endyear = int(ledger.enddate()[:4])
+        if "year" in query:
+            firstyear = endyear = int(query["year"])
+        result = {}
+        for year, (balances, rollups) in web.year_end_balances(ledger, firstyear, endyear).items():
+            result[str(year)] = {
+                "balances": dict((account, amounts(balance)) for (account, balance) in balances.items() if balance),
+                "rollups": dict((prefix, amounts(balance)) for (prefix, balance) in rollups.items()),
+            }
+        return result
+
+class LedgerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    routes = { "/balance": LedgerServer.balance, "/register": LedgerServer.register, "/report": LedgerServer.report }
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path not in self.routes:
+            return self.reply(404, {"error": "Unknown query %s" % url.path})
+
+        errors = self.server.errors
+        try:
+            self.server.check()
+        except (errors.ParseError, errors.AssertionError, IOError, OSError), e:
+            return self.reply(500, {"error": str(e)})
+
+        try:
+            result = self.routes[url.path](self.server, query)
+        except errors.AccountNotFoundError, e:
+            return self.reply(404, {"error": str(e)})
+        except ValueError, e:
+            return self.reply(400, {"error": str(e)})
+        self.reply(200, result)
+
+    def reply(self, code, result):
+        body = json.dumps(result, sort_keys=True)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Dashboards poll constantly, so don't log every request
+    def log_message(self, format, *args):
+        pass
+
+def serve(ledger, host="127.0.0.1", port=8000, interval=1.0):
+    server = LedgerServer((host, port), ledger, interval)
+    print "Serving %s on http://%s:%d/" % (ledger.root, host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -4,6 +4,9 @@ import unittest
 import uledger
 import textwrap
 import decimal
+import os
+import shutil
+import tempfile
 
 class LedgerTest(unittest.TestCase):
     def setUp(self):
@@ -258,6 +261,131 @@ class Math(LedgerTest):
 
 
 
+    def test_outoforder_index(self):
+        data = textwrap.dedent("""
+        2015-03-01 Test
+            SourceAccount   $10
+            DestAccount
+
+        2015-01-01 Test
+            SourceAccount   $1
+            DestAccount
+
+        2015-03-01 Test
+            SourceAccount   $100
+            DestAccount
+
+        2015-02-01 Test
+            SourceAccount   5 CAD
+            DestAccount""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        self.assertEquals(self.ledger.balance("SourceAccount","2014-12-31"), {})
+        self.assertEquals(self.ledger.balance("SourceAccount","2015-01-31"), {"$": 1})
+        self.assertEquals(self.ledger.balance("SourceAccount","2015-02-28"), {"$": 1, "CAD": 5})
+        self.assertEquals(self.ledger.balance("SourceAccount","2015-03-01"), {"$": 111, "CAD": 5})
+        self.assertEquals(self.ledger.balance("DestAccount"), {"$": -111, "CAD": -5})
+
+    def test_deferred_assert(self):
+        data = textwrap.dedent("""
+        2015-01-03 Test
+            SourceAccount   $50
+            DestAccount
+
+        assert balance SourceAccount  $50
+        assert balance 2015-01-05 SourceAccount  $50
+        assert equation 2015-01-05 SourceAccount - Liabilities = Equity + Income - DestAccount
+
+        2015-01-01 Test
+            SourceAccount   $10
+            DestAccount
+        """)
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        ledger = uledger.Ledger(deferred=True)
+        with self.assertRaises(uledger.AssertionError) as cm:
+            ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(cm.exception.filename, "TESTDATA")
+        self.assertEquals(cm.exception.linenum, 6)
+
+    def test_deferred_assert_pass(self):
+        data = textwrap.dedent("""
+        2015-01-03 Test
+            SourceAccount   $50
+            DestAccount
+
+        assert balance SourceAccount  $60
+        assert balance 2015-01-02 SourceAccount  $10
+
+        2015-01-01 Test
+            SourceAccount   $10
+            DestAccount
+        """)
+
+        ledger = uledger.Ledger(deferred=True)
+        ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(ledger.pending_assertions, [])
+
+    def test_deferred_failures(self):
+        data = textwrap.dedent("""
+        2015-01-03 Test
+            SourceAccount   $50
+            DestAccount
+
+        assert balance SourceAccount  $70
+        assert balance 2015-01-02 SourceAccount  $10
+        assert balance 2015-01-01 DestAccount  $0
+        """)
+
+        ledger = uledger.Ledger(deferred=True)
+        with self.assertRaises(uledger.AssertionError) as cm:
+            ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals([(e.filename, e.linenum) for e in ledger.failures], [("TESTDATA", 7), ("TESTDATA", 6)])
+        self.assertTrue(cm.exception is ledger.failures[0])
+        self.assertTrue("{'$': Decimal('50')} on 2015-01-03" in str(ledger.failures[1]))
+
+        ledger = uledger.Ledger(deferred=True)
+        ledger.unchecked = set(["TESTDATA"])
+        ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(ledger.failures, [])
+
+        # Assertions dated on or after a removed transaction are checked
+        ledger = uledger.Ledger(deferred=True)
+        ledger.unchecked = set(["TESTDATA"])
+        ledger.changedfrom = "2015-01-03"
+        with self.assertRaises(uledger.AssertionError):
+            ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals([(e.filename, e.linenum) for e in ledger.failures], [("TESTDATA", 6)])
+
+    def test_overflow(self):
+        data = textwrap.dedent("""
+        2015-01-01 Test
+            SourceAccount    12.000000000000000001 ETH
+            DestAccount""")
+        with self.assertRaises(uledger.ParseError) as cm:
+            self.ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(cm.exception.linenum, 2)
+        self.assertEquals(len(self.ledger.store), 0)
+
+        # Widening what is already stored would overflow, so nothing is
+        # rescaled
+        data = textwrap.dedent("""
+        2015-01-01 Test
+            SourceAccount    10000000 ETH
+            DestAccount
+
+        2015-01-02 Test
+            SourceAccount    0.000000000001 ETH
+            DestAccount""")
+        ledger = uledger.Ledger()
+        with self.assertRaises(uledger.ParseError) as cm:
+            ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(cm.exception.linenum, 6)
+        self.assertEquals(list(ledger.store.amount), [10000000, -10000000])
+        self.assertEquals(ledger.balance("SourceAccount"), {"ETH": 10000000})
+
     def test_nobalance(self):
         data = textwrap.dedent("""
         2015-01-01 Test
@@ -352,6 +480,22 @@ class Math(LedgerTest):
         self.assertEquals(self.ledger.balance("DestAccount"), {"$":-100,"CAD":-50})
         self.assertEquals(self.ledger.balance_children("Source"), {"$":100,"CAD":50})
 
+    def test_balance_children_segments(self):
+        data = textwrap.dedent("""
+        2015-01-01 Test
+            Assets:Bank    $50
+            Assets:Bank:Savings    $10
+            Assets:Bank2    $20
+            Equity
+            """)
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        self.assertEquals(self.ledger.balance_children("Assets:Bank"), {"$":60})
+        self.assertEquals(self.ledger.balance_children("Assets"), {"$":80})
+        self.assertEquals(self.ledger.balance_children("Assets:Ba"), {})
+        self.assertEquals(self.ledger.balance_children("Assets:Bank","2014-12-31"), {})
+
     def test_closeall(self):
         data = textwrap.dedent("""
         2015-01-01 Test
@@ -369,6 +513,128 @@ class Math(LedgerTest):
         self.assertEquals(self.ledger.balance_children("Source"), {"$":0,"CAD":0})
         self.assertEquals(self.ledger.balance("DestAccount2"), {"$":150,"CAD":50})
 
+    def test_closeall_outoforder(self):
+        data = textwrap.dedent("""
+        2015-01-01 Test
+            Income:Salary    $-50
+            Assets
+
+        closeall 2015-12-31 Income  Equity
+        closeall 2015-12-31 Equity  Equity:Retained
+
+        2015-06-01 Test
+            Income:Bonus    $-10
+            Assets
+
+        2016-01-01 Test
+            Income:Salary    $-5
+            Assets""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        self.assertEquals(self.ledger.balance_children("Income", "2015-12-31"), {"$":0})
+        self.assertEquals(self.ledger.balance_children("Income"), {"$":-5})
+        self.assertEquals(self.ledger.balance("Equity:Retained"), {"$":-60})
+        self.assertEquals(self.ledger.balance_children("Equity"), {"$":-60})
+
+    def test_closeall_assert(self):
+        data = textwrap.dedent("""
+        2015-01-01 Test
+            Income:Salary    $-50
+            Assets
+
+        closeall 2015-12-31 Income  Equity
+        assert balance Equity  $-50""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+        self.assertEquals(self.ledger.pending_closealls, [])
+
+    def test_register(self):
+        data = textwrap.dedent("""
+        2015-01-03 Third
+            Source:Account1    $25
+            DestAccount
+
+        2015-01-01 First
+            Source:Account1    $50
+            Source:Account2    $10
+            DestAccount
+
+        2015-01-02 Second
+            Source:Account2    $5
+            DestAccount""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        rows = list(self.ledger.register("Source", "2015-01-02"))
+        self.assertEquals([(r.date, r.account, r.value, r.balance, r.description) for r in rows], [
+            ("2015-01-02", "Source:Account2", 5, 15, "Second"),
+            ("2015-01-03", "Source:Account1", 25, 75, "Third"),
+        ])
+
+        rows = list(self.ledger.register(end="2015-01-01"))
+        self.assertEquals([(r.account, r.balance) for r in rows], [
+            ("DestAccount", -60), ("Source:Account1", 50), ("Source:Account2", 10),
+        ])
+
+    def test_transactions_between(self):
+        data = textwrap.dedent("""
+        2015-02-03 Third
+            Source:Account1    $25
+            DestAccount
+
+        2015-01-01 First
+            Source:Account1    $50
+            DestAccount
+
+        2015-02-01 Second
+            Source:Account2    5 CAD
+            DestAccount""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        found = list(self.ledger.transactions_between("2015-02-01", "2015-02-28"))
+        self.assertEquals([(t.description, t.linenum) for (t, posts) in found], [("Second", 10), ("Third", 2)])
+        self.assertEquals(found[0][1], [
+            uledger.Post("Source:Account2", uledger.Amount("CAD", 5), "TESTDATA", 10),
+            uledger.Post("DestAccount", uledger.Amount("CAD", -5), "TESTDATA", 10),
+        ])
+        self.assertEquals(len(list(self.ledger.transactions_between(end="2015-01-31"))), 1)
+        index = self.ledger.transactions
+        self.assertEquals(list(index.between("2015-01-01", "2015-01-01")), [1])
+        self.assertEquals(index.transaction(1), uledger.Transaction("2015-01-01", "First", 6, "TESTDATA"))
+        self.assertEquals(len(self.ledger.store.descriptions), 3)
+
+        self.assertEquals(self.ledger.balance("DestAccount", "2015-02-28", "2015-02-01"), {"$": -25, "CAD": -5})
+        self.assertEquals(self.ledger.balance("Source:Account1", "2015-02-02", "2015-02-01"), {"$": 0})
+        self.assertEquals(self.ledger.balance_children("Source", start="2015-02-02"), {"$": 25, "CAD": 0})
+
+    def test_prices(self):
+        data = textwrap.dedent("""
+        P 2015-01-01 CAD $0.80
+        P 2016-01-01 CAD $0.75
+        P 2015-06-01 $ 0.5 EUR
+
+        2015-03-01 Test
+            Assets:Bank    100 CAD
+            Assets:Cash    $10
+            Equity""")
+
+        self.ledger.parse(data.splitlines(),"TESTDATA")
+
+        self.assertEquals(self.ledger.price("CAD", "$", "2015-12-31"), decimal.Decimal("0.80"))
+        self.assertEquals(self.ledger.price("CAD", "$"), decimal.Decimal("0.75"))
+        self.assertEquals(self.ledger.price("EUR", "$", "2015-06-01"), 2)
+        with self.assertRaises(uledger.PriceNotFoundError):
+            self.ledger.price("CAD", "$", "2014-12-31")
+        with self.assertRaises(uledger.PriceNotFoundError):
+            self.ledger.price("CAD", "EUR")
+
+        balance = self.ledger.balance_children("Assets")
+        self.assertEquals(self.ledger.value(balance, "$", "2015-12-31"), 90)
+        self.assertEquals(self.ledger.value(balance, "$"), 85)
+        self.assertEquals(self.ledger.prices.memo[("CAD", "$", None)], decimal.Decimal("0.75"))
+
     def test_multitotal(self):
         data = textwrap.dedent("""
         bucket Savings
@@ -424,6 +690,761 @@ class Math(LedgerTest):
             self.ledger.parse(data.splitlines(),"TESTDATA")
 
 
+class Report(unittest.TestCase):
+
+    def test_year_end_balances(self):
+        import web
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        2014-06-01 Test
+            Org:Assets:Bank    $50
+            Org:Assets:Bank:Savings    10 CAD
+            Org:Equity
+
+        2016-01-01 Test
+            Org:Assets:Bank    $25
+            Org:Equity""").splitlines(), "TESTDATA")
+
+        snapshots = web.year_end_balances(ledger, 2014, 2016)
+        self.assertEquals(sorted(snapshots.keys()), [2014, 2015, 2016])
+        for year, (balances, rollups) in snapshots.items():
+            asof = "%d-12-31" % year
+            self.assertEquals(balances, ledger.balances(asof))
+            for prefix in ["Org", "Org:Assets", "Org:Assets:Bank", "Org:Equity"]:
+                self.assertEquals(rollups[prefix], ledger.balance_children(prefix, asof))
+
+    def test_report_range(self):
+        import web
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        2015-03-01 Test
+            Org:Income:Salary    $-100
+            Org:Assets:Bank
+
+        2016-01-15 Test
+            Org:Income:Salary    $-10
+            Org:Assets:Bank
+
+        2016-06-01 Test
+            Org:Income:Salary    $-1
+            Org:Assets:Bank""").splitlines(), "TESTDATA")
+
+        snapshots = web.year_end_balances(ledger, 2015, 2016, "2015-06-01", "2016-02-01")
+        balances, rollups = snapshots[2016]
+        self.assertEquals(balances["Org:Assets:Bank"], ledger.balance("Org:Assets:Bank", "2016-02-01"))
+        self.assertEquals(balances["Org:Income:Salary"], {"$": -10})
+        self.assertEquals(rollups["Org:Income"], {"$": -10})
+        self.assertEquals(snapshots[2015][0]["Org:Income:Salary"], {"$": 0})
+
+        destdir = tempfile.mkdtemp()
+        try:
+            web.make_report(ledger, destdir, end="2016-02-01")
+            with open(os.path.join(destdir, "report.html")) as f:
+                html = f.read()
+        finally:
+            shutil.rmtree(destdir)
+        self.assertTrue("Org as of 2016-02-01" in html)
+        self.assertTrue("Org EOY 2015" in html)
+        self.assertTrue("$ 110.00" in html)
+
+    def test_split(self):
+        import web
+        data = textwrap.dedent("""
+        2014-06-01 Test
+            Org:Assets:Bank    $50
+            Org:Equity
+
+        2015-06-01 Test
+            Org:Assets:Bank    $25
+            Org:Equity""")
+        ledger = uledger.Ledger()
+        ledger.parse(data.splitlines(), "TESTDATA")
+
+        destdir = tempfile.mkdtemp()
+        try:
+            web.make_report(ledger, destdir, split=True)
+            self.assertTrue(os.path.exists(os.path.join(destdir, "report-2014.html")))
+            os.unlink(os.path.join(destdir, "report-2014.html"))
+            os.unlink(os.path.join(destdir, "report-2015.html"))
+            with open(os.path.join(destdir, "report-2014.html"), "w") as f:
+                f.write("unchanged")
+
+            ledger = uledger.Ledger()
+            ledger.parse((data + "\n\n2015-07-01 Test\n    Org:Assets:Bank    $1\n    Org:Equity").splitlines(), "TESTDATA")
+            web.make_report(ledger, destdir, split=True)
+            with open(os.path.join(destdir, "report-2014.html")) as f:
+                self.assertEquals(f.read(), "unchanged")
+            with open(os.path.join(destdir, "report-2015.html")) as f:
+                self.assertTrue("76.00" in f.read())
+        finally:
+            shutil.rmtree(destdir)
+
+    @unittest.skipIf(uledger.numpy is None, "numpy is not installed")
+    def test_sweep_numpy(self):
+        import bench, copy
+        directory = tempfile.mkdtemp()
+        try:
+            ledger = uledger.Ledger()
+            ledger.load(bench.generate(directory, transactions=500, accounts=12, commodities=3, includes=0, outoforder=0.3, asserts=0, seed=2))
+        finally:
+            shutil.rmtree(directory)
+        dates = ["2004-12-31", "2007-02-31", "2009-12-31", "2015-01-01"]
+        expected = [copy.deepcopy(result) for result in ledger.pysweep(dates)]
+        self.assertEquals(list(ledger.npsweep(dates)), expected)
+        self.assertEquals(expected[0][1:], ({}, {}))
+
+    @unittest.skipIf(uledger.numpy is None, "numpy is not installed")
+    def test_cumulative_empty(self):
+        self.assertEquals(list(uledger.cumulative(uledger.PostingStore(), [20150101])), [{}])
+
+    def test_periodic(self):
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        2015-03-15 Test
+            Assets:Bank    $50
+            Equity
+
+        2014-12-31 Test
+            Assets:Bank    $10
+            Equity
+
+        2015-01-31 Test
+            Assets:Cash    5 CAD
+            Equity
+
+        2015-04-01 Test
+            Assets:Cash    $1.25
+            Assets:Bank""").splitlines(), "TESTDATA")
+
+        table = ledger.periodic("quarterly", "2015-01-01")
+        self.assertEquals(table.periods, ["2015-Q1", "2015-Q2"])
+        self.assertEquals(table.balances["Assets:Bank"], {"$": [60, decimal.Decimal("58.75")]})
+        self.assertEquals(table.deltas["Assets:Bank"], {"$": [50, decimal.Decimal("-1.25")]})
+        self.assertEquals(table.balances["Assets:Cash"], {"$": [0, decimal.Decimal("1.25")], "CAD": [5, 5]})
+
+        table = ledger.periodic("monthly", rollup=True)
+        self.assertEquals(table.periods, ["2014-12", "2015-01", "2015-02", "2015-03", "2015-04"])
+        self.assertEquals(table.balances["Assets"]["$"], [10, 10, 10, 60, 60])
+        self.assertEquals(table.deltas["Assets"]["CAD"], [0, 5, 0, 0, 0])
+        self.assertEquals(ledger.periodic("yearly").periods, ["2014", "2015"])
+        self.assertEquals(ledger.periodic("monthly", end="2014-06-01"), uledger.PeriodTable([], {}, {}))
+
+    def test_periodic_empty(self):
+        ledger = uledger.Ledger()
+        self.assertEquals(ledger.periodic(), uledger.PeriodTable([], {}, {}))
+        self.assertEquals(ledger.periodic("monthly", start="2015-01-01"), uledger.PeriodTable([], {}, {}))
+
+class Store(unittest.TestCase):
+
+    def test_rescale(self):
+        store = uledger.PostingStore()
+        dollars = store.commodityid("$")
+        cad = store.commodityid("CAD")
+        store.add("A", "2015-01-02", "One", dollars, 50)
+        store.rescale(dollars, 1)
+        store.add("B", "2015-01-01", "Two", dollars, -15)
+        store.rescale(cad, 3)
+        store.add("A", "2015-01-01", "Three", cad, 2125)
+        store.rescale(dollars, 2)
+        store.add("A", "2015-01-01", "Four", dollars, 25)
+
+        self.assertEquals(list(store.amount), [5000, -150, 2125, 25])
+        self.assertEquals([store.entry(row) for row in store.sortedrows("A")], [
+            ("2015-01-01", uledger.Entry("Three", uledger.Amount("CAD", decimal.Decimal("2.125")))),
+            ("2015-01-01", uledger.Entry("Four", uledger.Amount("$", decimal.Decimal("0.25")))),
+            ("2015-01-02", uledger.Entry("One", uledger.Amount("$", decimal.Decimal("50")))),
+        ])
+        self.assertEquals(len(store.descriptions), 4)
+        self.assertEquals(store.accountnames, ["A", "B"])
+
+    def test_ledger_rescale(self):
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        2015-01-01 Test
+            Source    $50
+            Dest
+
+        assert balance Source  $50.00
+
+        2015-01-02 Test
+            Source    $0.125
+            Dest""").splitlines(), "TESTDATA")
+
+        self.assertEquals(ledger.balance("Source", "2015-01-01"), {"$": 50})
+        self.assertEquals(ledger.balance("Source"), {"$": decimal.Decimal("50.125")})
+        self.assertEquals(ledger.balance_children("Dest"), {"$": decimal.Decimal("-50.125")})
+        self.assertEquals(list(ledger.store.amount), [50000, -50000, 125, -125])
+
+    def test_alias_redefined(self):
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        alias cash Assets:Cash
+        2015-01-01 Test
+            cash    $50
+            Equity
+
+        alias cash Assets:Wallet
+        2015-01-02 Test
+            cash    $10
+            Equity""").splitlines(), "TESTDATA")
+
+        self.assertEquals(ledger.balance("Assets:Cash"), {"$": 50})
+        self.assertEquals(ledger.balance("Assets:Wallet"), {"$": 10})
+        self.assertFalse("cash" in ledger.accounts)
+
+    def test_symbols(self):
+        ledger = uledger.Ledger()
+        ledger.parse(textwrap.dedent("""
+        2015-01-01 Test
+            Assets:Bank:Checking    $50
+            Assets:Cash    $5
+            Equity""").splitlines(), "TESTDATA")
+
+        symbols = ledger.symbols
+        a = symbols.id("Assets:Bank:Checking")
+        self.assertEquals(ledger.accounts["Assets:Bank:Checking"], a)
+        self.assertEquals(symbols.prefixes[a], ["Assets", "Assets:Bank", "Assets:Bank:Checking"])
+        self.assertEquals(symbols.parent("Assets:Bank:Checking"), "Assets:Bank")
+        self.assertEquals(symbols.parent("Assets"), None)
+        self.assertEquals(symbols.children("Assets"), ["Assets:Bank", "Assets:Cash"])
+        self.assertEquals(symbols.children("Nowhere"), [])
+        self.assertTrue(symbols.node("Assets:Bank") is symbols.paths[a][1])
+
+
+class Files(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmpdir, "journal.ledger")
+        self.included = os.path.join(self.tmpdir, "included.ledger")
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.write(self.included, """
+        2015-01-01 Test
+            SourceAccount   $50
+            DestAccount
+        """)
+        self.write(self.journal, """
+        include %s
+        assert balance SourceAccount  $50
+        """ % self.included)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, data):
+        with open(filename, "w") as f:
+            f.write(textwrap.dedent(data))
+
+    def test_warm(self):
+        ledger = uledger.Ledger(cache=self.cachedir)
+        ledger.load(self.journal)
+        self.assertEquals(len(os.listdir(self.cachedir)), 2)
+
+        ledger = uledger.Ledger(cache=self.cachedir)
+        ledger.load(self.journal)
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 50})
+
+    def test_changed(self):
+        uledger.Ledger(cache=self.cachedir).load(self.journal)
+
+        self.write(self.included, """
+        2015-01-01 Test
+            SourceAccount   $60
+            DestAccount
+        """)
+        os.utime(self.included, (0, 0))
+        with self.assertRaises(uledger.AssertionError):
+            uledger.Ledger(cache=self.cachedir).load(self.journal)
+
+    def test_touched(self):
+        cache = uledger.JournalCache(self.cachedir)
+        records = cache.tokenized(self.included).records
+        os.utime(self.included, (0, 0))
+        self.assertEquals(cache.tokenized(self.included).records, records)
+        self.assertEquals(cache.read(self.included)[0][2], 0)
+
+    def test_cache_from_main(self):
+        import subprocess, sys
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uledger.py")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call([sys.executable, script, "-f", self.journal, "-c", self.cachedir, "balance"], stdout=devnull)
+        cache = uledger.JournalCache(self.cachedir)
+        self.assertEquals(cache.records(cache.read(self.included)[1])[0][1].description, "Test")
+        ledger = uledger.Ledger(cache=self.cachedir)
+        ledger.load(self.journal)
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 50})
+
+        with open(cache.path(self.included), "wb") as f:
+            f.write("c__main__\nMissing\n.")
+        self.assertEquals(cache.read(self.included), None)
+        self.assertEquals(cache.tokenized(self.included).records[0][1].description, "Test")
+
+        # Records that don't decode are a miss too
+        header, encoded = cache.read(self.included)
+        cache.write(self.included, header[1], header[2], header[3], encoded[:-10])
+        self.assertEquals(cache.tokenized(self.included).records[0][1].description, "Test")
+        self.assertEquals(cache.read(self.included)[1], encoded)
+
+    def test_snapshot_cli(self):
+        import subprocess, sys
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uledger.py")
+        snapshot = os.path.join(self.tmpdir, "ledger.snapshot")
+        def balance(*options):
+            return subprocess.check_output([sys.executable, script, "-f", self.journal, "balance"] + list(options))
+
+        expected = balance()
+        self.assertEquals(balance("--snapshot", snapshot), expected)
+        self.assertTrue(os.path.exists(snapshot))
+        self.assertEquals(balance("--snapshot", snapshot), expected)
+
+        self.append(self.journal, """
+        2015-02-01 Test
+            SourceAccount   $5
+            New:Account
+        """)
+        self.assertEquals(balance("--snapshot", snapshot), balance())
+        loaded = uledger.Ledger()
+        loaded.load_snapshot(snapshot)
+        self.assertEquals(loaded.balance("New:Account"), {"$": -5})
+
+    def test_check_changed(self):
+        import json, subprocess, sys
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uledger.py")
+        statefile = os.path.join(self.tmpdir, "check.json")
+        def check(*options):
+            with open(os.devnull, "w") as devnull:
+                return subprocess.call([sys.executable, script, "-f", self.journal, "check"] + list(options), stdout=devnull)
+
+        self.assertEquals(check(), 0)
+        self.assertFalse(os.path.exists(self.journal + ".check.json"))
+        self.assertEquals(check("--state", statefile), 0)
+        with open(statefile) as f:
+            state = json.load(f)
+        self.assertEquals(state[self.included]["first"], "2015-01-01")
+        self.assertTrue(state[self.journal]["passed"])
+
+        # The journal is unchanged, but its assertion is dated after a
+        # transaction added to the included file
+        self.append(self.included, """
+        2014-12-31 Test
+            SourceAccount   $5
+            DestAccount
+        """)
+        self.assertEquals(check("--changed", "--state", statefile), 1)
+        with open(statefile) as f:
+            self.assertFalse(json.load(f)[self.journal]["passed"])
+
+    def test_check_changed_alias(self):
+        import subprocess, sys
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uledger.py")
+        statefile = os.path.join(self.tmpdir, "check.json")
+        aliases = os.path.join(self.tmpdir, "aliases.ledger")
+        def check(*options):
+            with open(os.devnull, "w") as devnull:
+                return subprocess.call([sys.executable, script, "-f", self.journal, "check", "--state", statefile] + list(options), stdout=devnull)
+
+        self.write(aliases, """
+        alias cash SourceAccount
+        """)
+        self.write(self.included, """
+        2015-01-01 Test
+            cash   $50
+            DestAccount
+
+        assert balance 2015-01-01 SourceAccount  $50
+        """)
+        self.write(self.journal, """
+        include %s
+        include %s
+        """ % (aliases, self.included))
+        self.assertEquals(check(), 0)
+        self.assertEquals(check("--changed"), 0)
+
+        # The alias file has no transactions, but changes what every
+        # later post means
+        self.write(aliases, """
+        alias cash Assets:Cash
+        """)
+        self.assertEquals(check("--changed"), 1)
+        self.assertEquals(check("--changed"), 1)
+
+    def append(self, filename, data):
+        with open(filename, "a") as f:
+            f.write(textwrap.dedent(data))
+
+    def test_refresh(self):
+        self.write(self.journal, """
+        include %s
+        """ % self.included)
+        self.append(self.included, """
+        bucket DestAccount
+        """)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        store = ledger.store
+        self.assertFalse(ledger.refresh())
+
+        self.append(self.included, """
+        2015-01-02 Test
+            SourceAccount   $5
+
+        assert balance SourceAccount  $55
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("DestAccount"), {"$": -55})
+
+        self.append(self.journal, """
+        2015-01-03 Test
+            SourceAccount   $5
+            DestAccount
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 60})
+        self.assertEquals(ledger.balance("DestAccount"), {"$": -60})
+        self.assertTrue(ledger.store is store)
+
+        self.append(self.journal, """
+        2015-01-04 Test
+            SourceAccount   5
+        """)
+        with self.assertRaises(uledger.ParseError) as cm:
+            ledger.refresh()
+        self.assertEquals(cm.exception.linenum, 9)
+
+    def test_refresh_assertions(self):
+        self.write(self.journal, """
+        include %s
+        assert balance 2015-01-31 SourceAccount  $50
+        """ % self.included)
+        ledger = uledger.Ledger(deferred=True)
+        ledger.load(self.journal)
+        store = ledger.store
+
+        self.append(self.journal, """
+        2015-02-01 Test
+            SourceAccount   $10
+            DestAccount
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertTrue(ledger.store is store)
+
+        # Dated before the assertion, so it has to be checked again
+        self.append(self.journal, """
+        2015-01-15 Test
+            SourceAccount   $10
+            DestAccount
+        """)
+        with self.assertRaises(uledger.AssertionError):
+            uledger.Ledger(deferred=True).load(self.journal)
+        with self.assertRaises(uledger.AssertionError):
+            ledger.refresh()
+
+        # Undated assertions see everything applied before them
+        self.write(self.journal, """
+        include %s
+        assert balance SourceAccount  $50
+        """ % self.included)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        self.append(self.included, """
+        2015-02-01 Test
+            SourceAccount   $10
+            DestAccount
+        """)
+        with self.assertRaises(uledger.AssertionError):
+            ledger.refresh()
+
+        # Text appended to the journal comes after the included file, so
+        # the included file no longer ends last
+        self.write(self.journal, """
+        include %s
+        """ % self.included)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        self.append(self.journal, """
+        alias cash Assets:Cash
+        """)
+        self.assertTrue(ledger.refresh())
+        self.append(self.included, """
+        2015-02-01 Test
+            cash   $5
+            DestAccount
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("cash"), {"$": 5})
+        self.append(self.journal, """
+        assert balance cash  $5
+        """)
+        self.assertTrue(ledger.refresh())
+        fresh = uledger.Ledger()
+        fresh.load(self.journal)
+        self.assertEquals(ledger.balances(), fresh.balances())
+
+    def test_refresh_closeall(self):
+        self.write(self.journal, """
+        2015-01-01 Test
+            Income:Salary   $-50
+            Assets:Bank
+
+        closeall 2015-12-31 Income  Equity:Retained
+        """)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        store = ledger.store
+
+        self.append(self.journal, """
+        2016-01-01 Test
+            Income:Salary   $-5
+            Assets:Bank
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertTrue(ledger.store is store)
+
+        self.append(self.journal, """
+        2015-06-01 Test
+            Income:Salary   $-10
+            Assets:Bank
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance_children("Income", "2015-12-31"), {"$": 0})
+        self.assertEquals(ledger.balance_children("Equity", "2015-12-31"), {"$": -60})
+        fresh = uledger.Ledger()
+        fresh.load(self.journal)
+        self.assertEquals(ledger.balances(), fresh.balances())
+
+    def test_refresh_reload(self):
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        with open(self.included, "a") as f:
+            f.write("    DestAccount2   $5\n")
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("DestAccount2"), {"$": 5})
+
+        self.write(self.included, """
+        2015-01-01 Test
+            SourceAccount   $50
+            OtherAccount
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("OtherAccount"), {"$": -50})
+        self.assertFalse("DestAccount" in ledger.accounts)
+
+    def test_empty_include(self):
+        self.write(self.included, "")
+        ledger = uledger.Ledger(assertions=False)
+        ledger.load(self.journal)
+        self.assertEquals(ledger.accounts, {})
+
+        self.append(self.included, """
+        2015-01-01 Test
+            SourceAccount   $50
+            DestAccount""")
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 50})
+
+    def test_jobs(self):
+        ledger = uledger.Ledger()
+        ledger.load(self.journal, jobs=2)
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 50})
+        self.assertEquals(ledger.prefetched, {})
+
+    def test_jobs_error(self):
+        self.write(self.included, """
+        2015-01-01 Test
+            SourceAccount   50
+            DestAccount
+        """)
+        with self.assertRaises(uledger.ParseError) as cm:
+            uledger.Ledger().load(self.journal, jobs=2)
+        self.assertEquals(cm.exception.filename, self.included)
+        self.assertEquals(cm.exception.linenum, 3)
+
+    def test_error_order(self):
+        self.write(self.included, """
+        2015-01-01 Test
+            SourceAccount   $50
+            DestAccount
+        assert balance SourceAccount  $10
+
+        2015-01-02 Test
+            SourceAccount   $5
+            DestAccount
+        Unparseable
+        """)
+        def error(**kwargs):
+            cache = kwargs.pop("cache", None)
+            try:
+                uledger.Ledger(cache=cache).load(self.journal, **kwargs)
+            except (uledger.ParseError, uledger.AssertionError) as e:
+                return type(e), e.filename, e.linenum
+        expected = (uledger.AssertionError, self.included, 5)
+        self.assertEquals(error(), expected)
+        self.assertEquals(error(cache=self.cachedir), expected)
+        self.assertEquals(error(cache=self.cachedir), expected)
+        self.assertEquals(error(jobs=2), expected)
+        self.assertEquals(error(jobs=2, threads=True), expected)
+
+    def test_threads(self):
+        nested = os.path.join(self.tmpdir, "nested.ledger")
+        self.write(nested, """
+        2015-01-02 Nested
+            OtherAccount   $5
+            DestAccount
+        """)
+        self.append(self.included, "include %s\n" % nested)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal, jobs=3, threads=True)
+        self.assertEquals(ledger.balance("DestAccount"), {"$": -55})
+        self.assertEquals(sorted(ledger.files), sorted([self.journal, self.included, nested]))
+
+        self.append(nested, """
+        2015-01-03 Appended
+            OtherAccount   $1
+            DestAccount
+        """)
+        self.assertTrue(ledger.refresh())
+        self.assertEquals(ledger.balance("OtherAccount"), {"$": 6})
+
+    def test_load_async(self):
+        ledger = uledger.Ledger()
+        ledger.load_async(self.journal, jobs=2).get()
+        self.assertEquals(ledger.balance("SourceAccount"), {"$": 50})
+
+        os.unlink(self.included)
+        with self.assertRaises(IOError):
+            uledger.Ledger().load_async(self.journal).get()
+
+    def test_snapshot(self):
+        self.append(self.journal, """
+        alias cash Assets:Cash
+        P 2015-01-01 CAD $0.80
+        2015-01-05 Test
+            cash   5 CAD
+            DestAccount
+        """)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        snapshot = os.path.join(self.tmpdir, "ledger.snapshot")
+        ledger.save_snapshot(snapshot)
+
+        loaded = uledger.Ledger()
+        loaded.load_snapshot(snapshot)
+        self.assertEquals(loaded.balances(), ledger.balances())
+        self.assertEquals(list(loaded.register()), list(ledger.register()))
+        self.assertEquals(list(loaded.transactions_between()), list(ledger.transactions_between()))
+        self.assertEquals(loaded.balance_children("DestAccount", "2015-01-01"), {"$": -50})
+        self.assertEquals(loaded.value(loaded.balance("Assets:Cash"), "$"), 4)
+        self.assertEquals(loaded.files, ledger.files)
+        if uledger.numpy is not None:
+            self.assertTrue(loaded.mapped)
+            self.assertFalse(loaded.store.amount.flags.writeable)
+
+        loaded.parse(textwrap.dedent("""
+        2015-01-06 Test
+            cash   $1
+            New:Account""").splitlines(), "TESTDATA")
+        self.assertEquals(loaded.balance("Assets:Cash"), {"$": 1, "CAD": 5})
+        self.assertEquals(loaded.balance_children("New"), {"$": -1})
+        self.assertEquals(len(loaded.store), len(ledger.store) + 2)
+        self.assertFalse(loaded.mapped)
+        self.assertEquals(list(loaded.transactions_between())[:-1], list(ledger.transactions_between()))
+
+        with self.assertRaises(uledger.SnapshotError):
+            loaded.load_snapshot(self.journal)
+
+    def test_profile(self):
+        ledger = uledger.Ledger(profile=True)
+        ledger.load(self.journal)
+        profile = ledger.profile
+        self.assertEquals(profile.directives["transaction"][0], 1)
+        self.assertEquals(profile.directives["include"][0], 1)
+        self.assertEquals(profile.directives["assert balance"][0], 1)
+        self.assertEquals(sorted(profile.files), sorted([self.journal, self.included]))
+        self.assertEquals([(a["filename"], a["linenum"]) for a in profile.json()["assertions"]], [(self.journal, 3)])
+        self.assertTrue("%s:3" % self.journal in profile.table())
+
+    def test_serve(self):
+        import json, threading, urllib2, server
+        self.write(self.journal, """
+        include %s
+        assert balance 2015-01-01 SourceAccount  $50
+        """ % self.included)
+        ledger = uledger.Ledger()
+        ledger.load(self.journal)
+        httpd = server.LedgerServer(("127.0.0.1", 0), ledger, interval=0)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        def get(path):
+            try:
+                f = urllib2.urlopen("http://127.0.0.1:%d%s" % (httpd.server_port, path))
+                return f.getcode(), json.load(f)
+            except urllib2.HTTPError, e:
+                return e.code, json.load(e)
+        try:
+            self.assertEquals(get("/balance?account=SourceAccount"), (200, {"$": "50"}))
+            self.assertEquals(get("/balance?account=Missing")[0], 404)
+            self.assertEquals(get("/nowhere")[0], 404)
+
+            self.append(self.included, """
+            2015-02-01 Test
+                SourceAccount:Sub   $5
+                DestAccount""")
+            self.assertEquals(get("/balance?account=SourceAccount&children=1"), (200, {"$": "55"}))
+            self.assertEquals(get("/balance?asof=2015-01-31")[1]["DestAccount"], {"$": "-50"})
+            code, rows = get("/register?account=DestAccount")
+            self.assertEquals([(row["date"], row["balance"]) for row in rows], [("2015-01-01", "-50"), ("2015-02-01", "-55")])
+            self.assertEquals(get("/report")[1]["2015"]["rollups"]["SourceAccount"], {"$": "55"})
+
+            self.append(self.included, """
+            2015-03-01 Test
+                SourceAccount   5
+                DestAccount""")
+            self.assertEquals(get("/balance")[0], 500)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_serve_cli(self):
+        import json, re, subprocess, sys, urllib2
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uledger.py")
+        process = subprocess.Popen([sys.executable, "-u", script, "-f", self.journal, "serve", "--port", "0", "--interval", "0"], stdout=subprocess.PIPE)
+        def get(path):
+            try:
+                return urllib2.urlopen(url + path).getcode()
+            except urllib2.HTTPError, e:
+                json.load(e)
+                return e.code
+        try:
+            url = re.search(r"(http://\S+)/", process.stdout.readline()).group(1)
+            self.assertEquals(get("/balance?account=SourceAccount"), 200)
+            self.assertEquals(get("/balance?account=Missing"), 404)
+
+            self.append(self.included, """
+            2015-03-01 Test
+                SourceAccount   5
+                DestAccount""")
+            self.assertEquals(get("/balance"), 500)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+class Bench(unittest.TestCase):
+
+    def test_generate(self):
+        import bench
+        directory = tempfile.mkdtemp()
+        try:
+            filename = bench.generate(directory, transactions=500, accounts=10, commodities=2, includes=3, outoforder=0.2, asserts=0.2, seed=1)
+            for deferred in (False, True):
+                ledger = uledger.Ledger(deferred=deferred)
+                ledger.load(filename)
+                self.assertEquals(len(ledger.files), 4)
+                self.assertEquals(sum(ledger.balance_children(org).get("$", 0) for org in bench.ORGS), 0)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,91 @@
 #!/usr/bin/env python
 
 import argparse
+import array
+import bisect
+import cPickle
+import cStringIO
+import hashlib
+import json
+import marshal
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
 import re
+import struct
 import decimal
 import sys
-from collections import namedtuple
-import datetime
-
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# value is a Fixed while parsing and a Decimal once it leaves the Ledger
 Amount = namedtuple("Amount", ["commodity","value"])
+# An exact decimal number held as an integer count of 10**-places
+Fixed = namedtuple("Fixed", ["units","places"])
 Post = namedtuple('Post', ['account', "amount","filename","linenum"])
 Transaction = namedtuple("Transaction",["date","description","linenum","filename"])
 Entry = namedtuple('Entry',['description','amount'])
+# kind is "balance" or "equation".  For a balance assertion accounts is
+# a 1-tuple and amount is set; for an equation it is the five accounts
+# in assets, liabilities, equity, income, expense order
+Assertion = namedtuple("Assertion", ["kind","asof","accounts","amount","filename","linenum"])
+# What tokenizing a journal file produced.  size, mtime and digest
+# describe the content the records came from
+Tokenized = namedtuple("Tokenized", ["records","size","mtime","digest"])
+# Where parsing of a loaded file stopped, see Ledger.refresh().  bucket
+# is the bucket in effect at the end of the file, applied the ledger's
+# count of applied records at that point, and parents the files that
+# included it, outermost first
+FileState = namedtuple("FileState", ["offset","mtime","digest","bucket","applied","parents"])
+# balance is the account's running balance in commodity after this post
+RegisterRow = namedtuple("RegisterRow", ["date","account","commodity","value","balance","description"])
+# Returned by Ledger.periodic().  periods labels each period, and
+# balances and deltas map account -> commodity -> [Decimal per period]
+PeriodTable = namedtuple("PeriodTable", ["periods","balances","deltas"])
+
+# Every pattern is compiled once here.  parse() picks the pattern to try
+# from the first character or keyword of a line, so each line costs at
+# most one regex match.
+TRANSACTION_RE = re.compile(r"(?P<date>\d{4}-\d{2}-\d{2})(=(?P<postdate>\d{4}-\d{2}-\d{2}))?\s+(?P<description>.*)")
+POST_RE = re.compile(r"^\s+(?P<account>.*?)(\s\s+(?P<amount>.*))?$")
+
+DIRECTIVES = {
+    "commodity": re.compile(r"commodity\s+(?P<commodity>.*)"),
+    "account": re.compile(r"account\s+(?P<account>.*)"),
+    "include": re.compile(r"include\s+(?P<filename>.*)"),
+    "bucket": re.compile(r"bucket\s+(?P<account>.*)"),
+    "print": re.compile(r"print\s+(?P<str>.*)"),
+    "alias": re.compile(r"alias\s+(?P<alias>.*?)\s+(?P<account>.*)"),
+    "P": re.compile(r"P\s+(?P<date>\d{4}-\d{2}-\d{2})\s+(?P<commodity>\S+)\s+(?P<price>.*)"),
+    "closeall": re.compile(r"closeall\s+(?P<asof>\d{4}-\d{2}-\d{2})\s+(?P<prefix>.+?)\s\s+(?P<closingaccount>.*)"),
+    "assert balance": re.compile(r"assert\s+balance\s+(?P<asof>\d{4}-\d{2}-\d{2})?\s*(?P<account>.*?)\s\s+(?P<amount>.*)$"),
+    "assert equation": re.compile(r"assert\s+equation\s+(?P<asof>\d{4}-\d{2}-\d{2})?\s*(?P<assetsaccount>.*?)\s+-\s+(?P<liabilitiesaccount>.*?)\s+=\s+(?P<equityaccount>.*?)\s+\+\s+(?P<incomeaccount>.*?)\s+-\s+(?P<expenseaccount>.*?)$"),
+}
+
+# ($1234.12 + $123432.23)
+AMOUNT_ADD_RE = re.compile(r"\(\s*(?P<left>.*?)\s+\+\s+(?P<right>.*?)\s*\)")
+# ($1234.12 * 1.05)
+AMOUNT_MUL_RE = re.compile(r"\(\s*(?P<left>.*?)\s+\*\s+(?P<right>-?\d+(\.\d+)?)\s*\)")
+# $-1234.34
+AMOUNT_DOLLAR_RE = re.compile(r"(?P<commodity>\$)\s*(?P<value>-?[\d,]+(\.\d+)?)")
+# -123.43 CAD
+AMOUNT_COMMODITY_RE = re.compile(r"(?P<value>-?[\d,]+(\.\d+)?) (?P<commodity>\w+)")
+
+CENTS = decimal.Decimal('.01')
 
 class ParseError(Exception):
     def __init__(self, filename, linenum, msg):
+        # args lets the error be pickled back from a worker process
+        self.args = (filename, linenum, msg)
         self.msg = msg
         self.filename = filename
         self.linenum = linenum
@@ -35,339 +107,2033 @@ class AccountNotFoundError(Exception):
     def __str__(self):
         return "ERROR: Account '%s' not found" % (self.account)
 
+class SnapshotError(Exception):
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+    def __str__(self):
+        return "ERROR: %s: %s" % (self.path, self.msg)
 
-class Ledger(object):
+class PriceNotFoundError(Exception):
+    def __init__(self, commodity, currency, asof):
+        self.commodity = commodity
+        self.currency = currency
+        self.asof = asof
+    def __str__(self):
+        return "ERROR: No price for %s in %s as of %s" % (self.commodity, self.currency, self.asof)
 
-    # This is a dict of dates
-    #   each member is a transaction, sorted by parse order
-    transactions = {}
-    accounts = {}
-    aliases = {}
-    commodities = set()
 
-    def __init__(self, assertions=True):
-        self.transactions = {}
-        self.accounts = {}
-        self.aliases = {}
-        self.commodities = set()
-        self.assertions = assertions
+# "-1,234.56" -> Fixed(-123456, 2)
+def parsefixed(text):
+    whole, dot, fraction = text.replace(",","").partition(".")
+    return Fixed(int(whole + fraction), len(fraction))
 
-    def parseamount(self, amountstr, filename, linenum):
-        m = re.match("\((.*?)\)",amountstr)
+def fixedvalue(fixed):
+    return decimal.Decimal(fixed.units).scaleb(-fixed.places)
+
+# Returns fixed with its units expressed in 10**-places
+def rescaled(fixed, places):
+    if fixed.places == places:
+        return fixed.units
+    return fixed.units * 10 ** (places - fixed.places)
+
+def addfixed(a, b):
+    places = max(a.places, b.places)
+    return Fixed(rescaled(a, places) + rescaled(b, places), places)
+
+def parseamount(amountstr, filename, linenum):
+    first = amountstr[:1]
+    if first == "(":
+        m = AMOUNT_ADD_RE.match(amountstr)
         if m:
-            # $1234.12 + $123432.23
-            m = re.match("\(\s*(?P<left>.*?)\s+\+\s+(?P<right>.*?)\s*\)",amountstr)
-            if m:
-                a = self.parseamount(m.group("left"),filename,linenum)
-                b = self.parseamount(m.group("right"),filename,linenum)
-                return Amount(a.commodity,a.value+b.value)
+            a = parseamount(m.group("left"),filename,linenum)
+            b = parseamount(m.group("right"),filename,linenum)
+            return Amount(a.commodity,addfixed(a.value,b.value))
 
-            m = re.match("\(\s*(?P<left>.*?)\s+\*\s+(?P<right>-?\d+(\.\d+)?)\s*\)",amountstr)
-            if m:
-                a = self.parseamount(m.group("left"),filename,linenum)
-                b = decimal.Decimal(m.group("right"))
-                return Amount(a.commodity,(a.value*b).quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_HALF_UP))
+        # Multiplication is the only place Decimal is still needed, for
+        # its rounding
+        m = AMOUNT_MUL_RE.match(amountstr)
+        if m:
+            a = parseamount(m.group("left"),filename,linenum)
+            b = decimal.Decimal(m.group("right"))
+            value = (fixedvalue(a.value)*b).quantize(CENTS, rounding=decimal.ROUND_HALF_UP)
+            return Amount(a.commodity,Fixed(int(value.scaleb(2)), 2))
 
-        # $-1234.34
-        m = re.match("(?P<commodity>\$)\s*(?P<value>-?[\d,]+(\.\d+)?)",amountstr)
+    elif first == "$":
+        m = AMOUNT_DOLLAR_RE.match(amountstr)
         if m:
-            return Amount(m.group("commodity"),decimal.Decimal(m.group("value").replace(",","")))
+            return Amount(m.group("commodity"),parsefixed(m.group("value")))
 
-        # -123.43 CAD
-        m = re.match("(?P<value>-?[\d,]+(\.\d+)?) (?P<commodity>\w+)",amountstr)
+    else:
+        m = AMOUNT_COMMODITY_RE.match(amountstr)
         if m:
-            return Amount(m.group("commodity"),decimal.Decimal(m.group("value").replace(",","")))
+            return Amount(m.group("commodity"),parsefixed(m.group("value")))
+
+    raise ParseError(filename, linenum, "Don't know how to interpret '%s' as a value, did you include a commodity type ($, USD, etc)?" % amountstr)
+
+
+# Splits a journal into records without touching any ledger state, so
+# the result can be cached and replayed by Ledger.apply().  Each record
+# is a tuple starting with its kind:
+#   ("transaction", Transaction, posts, endlinenum)
+#   ("closeall", Transaction, prefix, closingaccount)
+#   ("bucket", account)
+#   ("alias", alias, account)
+#   ("price", date, commodity, Amount, linenum)
+#   ("include", filename)
+#   ("print", str)
+#   ("assert", kind, asof, accounts, amountstr, linenum)
+#   ("error", filename, linenum, msg)
+# endlinenum is the line that ended the transaction, or None at the end
+# of the file.  firstline is the line number of the reader's first line.
+# A line that can't be parsed ends the records with an error record
+# rather than raising, so the records before it are still applied, and
+# anything they raise is raised first, wherever the records were made.
+def tokenize(reader, filename=None, firstline=1):
+    try:
+        for record in tokenizelines(reader, filename, firstline):
+            yield record
+    except ParseError as e:
+        yield ("error", e.filename, e.linenum, e.msg)
 
-        raise ParseError(filename, linenum, "Don't know how to interpret '%s' as a value, did you include a commodity type ($, USD, etc)?" % amountstr)
-        return None
+def tokenizelines(reader, filename, firstline):
 
-    def makepost(self, account,date,description,commodity,value):
-        self.commodities.add(commodity)
-        if account not in self.accounts:
-            self.accounts[account] = {}
-        if date not in self.accounts[account]:
-            self.accounts[account][date] = []
+    transaction = None
+    accountdef = None
+    posts = []
+    for linenum, line in enumerate(reader, firstline):
+
+        line = line.rstrip()
+        if line == '' or line.lstrip(" ")[:1] == ";":
+            continue
+
+        indented = line[0].isspace()
+
+        if transaction is not None:
+            if indented:
+                m = POST_RE.match(line)
+                amount = None
+                if m.group("amount") is not None:
+                    amount = parseamount(m.group("amount"),filename,linenum)
+                post = Post(m.group("account"),amount,filename,linenum)
+                posts.append(post)
+                continue
+            else:
+                yield ("transaction", transaction, posts, linenum)
+                posts = []
+                transaction = None
 
-        self.accounts[account][date].append(Entry(description,Amount(commodity,value)))
+        if accountdef is not None:
+            # Ignore things under accountdef for now
+            if indented:
+                continue
+            else:
+                accountdef = None
 
+        if line[0].isdigit():
+            m = TRANSACTION_RE.match(line)
+            if m:
+                date = m.group("postdate") if m.group("postdate") is not None else m.group("date")
+                transaction = Transaction(date=date,description=m.group("description"),filename=filename,linenum=linenum)
+                continue
+            raise ParseError(filename, linenum, "Don't know how to parse \"%s\"" % line)
 
-    # We lexically sort the date keys, and start from
-    # the beginning to get the current balance
-    def balance(self, account, asof=None):
+        words = line.split(None, 2)
+        keyword = words[0]
+        if keyword == "assert" and len(words) > 1:
+            keyword = "assert " + words[1]
+        pattern = DIRECTIVES.get(keyword)
+        m = pattern.match(line) if pattern is not None and not indented else None
+        if m is None:
+            raise ParseError(filename, linenum, "Don't know how to parse \"%s\"" % line)
+
+        if keyword == "commodity":
+            continue
+
+        elif keyword == "account":
+            accountdef = m.groups()
+
+        elif keyword == "include":
+            yield ("include", m.group("filename"))
+
+        elif keyword == "bucket":
+            yield ("bucket", m.group("account"))
+
+        elif keyword == "print":
+            yield ("print", m.group("str"))
+
+        elif keyword == "alias":
+            yield ("alias", m.group("alias"), m.group("account"))
+
+        elif keyword == "P":
+            yield ("price", m.group("date"), m.group("commodity"), parseamount(m.group("price"), filename, linenum), linenum)
+
+        elif keyword == "closeall":
+            transaction = Transaction(date=m.group("asof"),description="Automatic closing transaction",filename=filename,linenum=linenum)
+            yield ("closeall", transaction, m.group("prefix"), m.group("closingaccount"))
+            transaction = None
+
+        elif keyword == "assert balance":
+            yield ("assert", "balance", m.group("asof"), (m.group("account"),), m.group("amount"), linenum)
+
+        elif keyword == "assert equation":
+            accounts = tuple(m.group("%saccount" % acct) for acct in ["assets","liabilities","equity","income","expense"])
+            yield ("assert", "equation", m.group("asof"), accounts, None, linenum)
+
+    if transaction is not None:
+        yield ("transaction", transaction, posts, None)
+
+
+# Records from tokenize() with every namedtuple in them replaced by a
+# plain tuple, and back again
+def plainrecords(records):
+    result = []
+    for record in records:
+        kind = record[0]
+        if kind == "transaction":
+            # Posts are (account, amount, filename, linenum) and amounts
+            # (commodity, value), indexed directly as that is much faster
+            posts = [(post[0], (post[1][0], tuple(post[1][1])) if post[1] is not None else None, post[2], post[3]) for post in record[2]]
+            record = (kind, tuple(record[1]), posts, record[3])
+        elif kind == "closeall":
+            record = (kind, tuple(record[1])) + record[2:]
+        elif kind == "price":
+            record = record[:3] + ((record[3][0], tuple(record[3][1])),) + record[4:]
+        result.append(record)
+    return result
+
+def typedrecords(records):
+    result = []
+    for record in records:
+        kind = record[0]
+        if kind == "transaction":
+            posts = [Post(account, Amount(amount[0], Fixed(*amount[1])) if amount is not None else None, filename, linenum) for (account, amount, filename, linenum) in record[2]]
+            record = (kind, Transaction(*record[1]), posts, record[3])
+        elif kind == "closeall":
+            record = (kind, Transaction(*record[1])) + record[2:]
+        elif kind == "price":
+            record = record[:3] + (Amount(record[3][0], Fixed(*record[3][1])),) + record[4:]
+        result.append(record)
+    return result
+
+
+# Stores the tokenized records of each journal file on disk.  Entries
+# are keyed by the file's absolute path and checked against its size and
+# mtime; if those changed, the content hash decides whether the file
+# really needs to be tokenized again.  An entry is a marshalled header,
+# (VERSION, size, mtime, digest), followed by the marshalled records as
+# plain tuples, which are much cheaper to write and read than a pickle.
+# An entry for a file that was only touched gets a new header and keeps
+# its encoded records as they are.
+#
+# The cache only saves tokenizing; the records are still replayed into
+# the ledger, which takes most of a load.  To start quickly on a large
+# journal, save a snapshot with Ledger.save_snapshot() and later
+# load_snapshot() and refresh() it, see --snapshot.
+class JournalCache(object):
+
+    # Bump whenever the record format produced by tokenize() changes
+    VERSION = 6
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, hashlib.sha1(os.path.abspath(filename)).hexdigest() + ".cache")
+
+    # Returns the header of filename's entry and its encoded records, or
+    # None.  Anything wrong with an entry, down to it having been written
+    # by a different version of this module, just makes it a miss
+    def read(self, filename):
+        try:
+            with open(self.path(filename), "rb") as f:
+                header = marshal.load(f)
+                encoded = f.read()
+            if header[0] != self.VERSION:
+                return None
+            return header, encoded
+        except Exception:
+            return None
+
+    # Records from an entry's encoded records, or None if they can't be
+    # decoded
+    def records(self, encoded):
+        try:
+            return typedrecords(marshal.loads(encoded))
+        except Exception:
+            return None
+
+    def write(self, filename, size, mtime, digest, encoded):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump((self.VERSION, size, mtime, digest), f)
+            f.write(encoded)
+        os.rename(tmp, self.path(filename))
+
+    # Returns filename as Tokenized, tokenizing it only if it changed
+    def tokenized(self, filename):
+        st = os.stat(filename)
+        entry = self.read(filename)
+        if entry is not None:
+            (version, size, mtime, digest), encoded = entry
+            if size == st.st_size and (mtime == st.st_mtime or digest == filedigest(filename)):
+                records = self.records(encoded)
+                if records is not None:
+                    if mtime != st.st_mtime:
+                        self.write(filename, size, st.st_mtime, digest, encoded)
+                    return Tokenized(records, size, st.st_mtime, digest)
+
+        tokenized = StreamedFile(filename).tokenized()
+        self.write(filename, tokenized.size, tokenized.mtime, tokenized.digest, marshal.dumps(plainrecords(tokenized.records)))
+        return tokenized
+
+
+# SHA-1 of a file's content, as kept in FileState.digest
+def filedigest(filename):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# A journal file tokenized as it is read, with the fields of Tokenized.
+# Each line is hashed as tokenize() reads it, so the digest always
+# matches the text the records came from without the whole file being
+# held in memory.  size and digest are only set once records has been
+# consumed, and the file is closed then
+class StreamedFile(object):
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.mtime = os.fstat(self.file.fileno()).st_mtime
+        self.size = None
+        self.digest = None
+        self.reader = self.lines()
+        self.records = tokenize(self.reader, filename)
+
+    def lines(self):
+        sha = hashlib.sha1()
+        size = 0
+        try:
+            for line in self.file:
+                sha.update(line)
+                size += len(line)
+                yield line
+        finally:
+            self.file.close()
+        self.size = size
+        self.digest = sha.hexdigest()
+
+    # Reads the rest of the file, including anything after a parse
+    # error, and returns it as Tokenized with the records in a list
+    def tokenized(self):
+        records = list(self.records)
+        for line in self.reader:
+            pass
+        return Tokenized(records, self.size, self.mtime, self.digest)
+
+
+# Tokenizes one file for Ledger.prefetch() in a worker process or
+# thread.  Files are read with plain file reads, which release the GIL
+# while slow storage answers, so threads overlap their reads.  A file
+# that can't be read is returned as the error rather than raised, so
+# that it surfaces when the include is reached, just as it would when
+# parsing sequentially.  Parse errors are already in the records
+def tokenizefile(args):
+    filename, cachedir = args
+    try:
+        if cachedir is not None:
+            return JournalCache(cachedir).tokenized(filename), None
+        return StreamedFile(filename).tokenized(), None
+    except EnvironmentError as e:
+        return None, e
+
+
+# Running totals for one account and commodity, as scaled ints (see
+# PostingStore).  dates holds date keys (see datekey()) in sorted order,
+# and totals[i] is the sum of every value posted on or before dates[i],
+# so an as-of balance is a single bisect.  Both are arrays, so an entry
+# costs 12 bytes rather than a list slot and an int object.  Posts
+# usually arrive in date order and are appended.  Out-of-order posts are
+# held in the pending arrays and merged in one pass the next time the
+# totals are read, so importing a batch of old transactions costs one
+# merge instead of one shift each.
+class RunningTotal(object):
+
+    def __init__(self):
+        self.dates = array.array('i')
+        self.totals = array.array(INT64)
+        self.pendingdates = array.array('i')
+        self.pendingvalues = array.array(INT64)
+
+    def add(self, date, value):
+        if self.pendingdates or (self.dates and date < self.dates[-1]):
+            self.pendingdates.append(date)
+            self.pendingvalues.append(value)
+        elif self.dates and date == self.dates[-1]:
+            self.totals[-1] += value
+        else:
+            self.dates.append(date)
+            self.totals.append((self.totals[-1] if self.totals else 0) + value)
+
+    def merge(self):
+        pendingdates = self.pendingdates
+        pendingvalues = self.pendingvalues
+        pending = sorted(xrange(len(pendingdates)), key=pendingdates.__getitem__)
+        dates = array.array('i')
+        totals = array.array(INT64)
+        total = 0
+        previous = 0
+        i = 0
+        j = 0
+        while i < len(self.dates) or j < len(pending):
+            if j == len(pending) or (i < len(self.dates) and self.dates[i] <= pendingdates[pending[j]]):
+                date = self.dates[i]
+                total += self.totals[i] - previous
+                previous = self.totals[i]
+                i += 1
+            else:
+                date = pendingdates[pending[j]]
+                total += pendingvalues[pending[j]]
+                j += 1
+            if dates and dates[-1] == date:
+                totals[-1] = total
+            else:
+                dates.append(date)
+                totals.append(total)
+        self.dates = dates
+        self.totals = totals
+        self.pendingdates = array.array('i')
+        self.pendingvalues = array.array(INT64)
+
+    def thaw(self):
+        self.dates = writable(self.dates, 'i')
+        self.totals = writable(self.totals, INT64)
+
+    def scale(self, factor):
+        self.totals = array.array(INT64, [total * factor for total in self.totals])
+        self.pendingvalues = array.array(INT64, [value * factor for value in self.pendingvalues])
+
+    # Returns None if nothing was posted before date
+    def before(self, date):
+        if self.pendingdates:
+            self.merge()
+        i = bisect.bisect_left(self.dates, datekey(date))
+        if i == 0:
+            return None
+        return self.totals[i-1]
+
+    # Returns None if nothing was posted on or before asof
+    def asof(self, asof=None):
+        if self.pendingdates:
+            self.merge()
+        if asof is None:
+            i = len(self.dates)
+        else:
+            i = bisect.bisect_right(self.dates, datekey(asof))
+        if i == 0:
+            return None
+        return self.totals[i-1]
+
+
+# Prices of each commodity in other commodities, from P directives.
+# Each (commodity, currency) pair keeps its prices sorted by date, and
+# lookups are memoized by (commodity, currency, date), so valuing
+# balances at the same dates again costs a dict lookup rather than a
+# search.
+class PriceTable(object):
+
+    def __init__(self):
+        # (commodity, currency) -> sorted dates, and the Decimal price on
+        # each of them
+        self.dates = {}
+        self.prices = {}
+        # (commodity, currency, asof) -> price()
+        self.memo = {}
+
+    def add(self, date, commodity, currency, price):
+        dates = self.dates.setdefault((commodity, currency), [])
+        prices = self.prices.setdefault((commodity, currency), [])
+        i = bisect.bisect_left(dates, date)
+        if i < len(dates) and dates[i] == date:
+            prices[i] = price
+        else:
+            dates.insert(i, date)
+            prices.insert(i, price)
+        self.memo = {}
+
+    # Latest price of commodity in currency on or before asof, or None
+    def lookup(self, commodity, currency, asof):
+        dates = self.dates.get((commodity, currency))
+        if not dates:
+            return None
+        i = len(dates) if asof is None else bisect.bisect_right(dates, asof)
+        if i == 0:
+            return None
+        return self.prices[(commodity, currency)][i-1]
+
+    # What one unit of commodity is worth in currency as of asof, from
+    # its own prices or else the inverse of currency's prices in it.
+    # None if neither is known
+    def price(self, commodity, currency, asof=None):
+        if commodity == currency:
+            return decimal.Decimal(1)
+        key = (commodity, currency, asof)
+        if key not in self.memo:
+            price = self.lookup(commodity, currency, asof)
+            if price is None:
+                inverse = self.lookup(currency, commodity, asof)
+                if inverse:
+                    price = 1 / inverse
+            self.memo[key] = price
+        return self.memo[key]
+
+
+# One node per colon-separated account segment.  totals holds the
+# running totals of every post made to this account or anything below
+# it, so a prefix rollup is a walk down the tree plus one lookup per
+# commodity.  account is set on nodes that have had posts made directly
+# to them.
+class AccountNode(object):
+
+    def __init__(self):
+        self.children = {}
+        self.totals = {}
+        self.account = None
+
+    def add(self, key, commodity, value):
+        if commodity not in self.totals:
+            self.totals[commodity] = RunningTotal()
+        self.totals[commodity].add(key, value)
+
+    # With start, only posts dated from start on are counted
+    def balance(self, asof=None, start=None):
+        result = {}
+        for commodity, totals in self.totals.items():
+            value = totals.asof(asof)
+            if value is not None:
+                if start is not None:
+                    value -= totals.before(start) or 0
+                result[commodity] = value
+        return result
+
+    def scale(self, commodity, factor):
+        if commodity in self.totals:
+            self.totals[commodity].scale(factor)
+        for child in self.children.values():
+            child.scale(commodity, factor)
+
+    # Names of every account at or below this node
+    def accounts(self):
+        if self.account is not None:
+            yield self.account
+        for child in self.children.values():
+            for account in child.accounts():
+                yield account
+
+
+# Typecode for 64-bit scaled amounts.  Python 2's array module has no
+# 'q', but 'l' is 64 bits wide on LP64 platforms
+INT64 = 'l' if array.array('l').itemsize == 8 else 'q'
+INT64_MAX = 2 ** 63 - 1
+
+# Returns column as an array.array that can be appended to.  Columns
+# loaded from a snapshot with numpy are read-only views of its map
+def writable(column, typecode):
+    if isinstance(column, array.array):
+        return column
+    result = array.array(typecode)
+    result.fromstring(column.tostring())
+    return result
+
+# Snapshot files start with SNAPSHOT_MAGIC and a version, then hold every
+# fixed-width column as raw machine words, 8-byte aligned, so they can
+# be used straight out of a memory map: the PostingStore columns and
+# per-account rows, the TransactionIndex columns, and the dates and
+# totals of every RunningTotal, end to end.  Descriptions follow, one
+# per line.  A small pickle of everything else comes last, and the last
+# 8 bytes give its offset.
+SNAPSHOT_MAGIC = "uledger snapshot"
+SNAPSHOT_VERSION = 6
+
+# Dates are stored as YYYYMMDD ints, which sort the same way as the
+# YYYY-MM-DD strings they come from
+def datekey(date):
+    return int(date[0:4] + date[5:7] + date[8:10])
+
+def datestr(key):
+    return "%04d-%02d-%02d" % (key // 10000, key // 100 % 100, key % 100)
+
+# Months in each period length accepted by Ledger.periodic()
+PERIODS = { "monthly": 1, "quarterly": 3, "yearly": 12 }
+
+# Returns [(label, last date)] for each period from the one holding
+# start to the one holding end, preceded by the period before them.  The
+# last date is always the 31st, which sorts after any real day of its
+# month
+def periodends(period, start, end):
+    months = PERIODS[period]
+    first = (int(start[0:4]) * 12 + int(start[5:7]) - 1) // months
+    last = (int(end[0:4]) * 12 + int(end[5:7]) - 1) // months
+    result = []
+    for k in range(first - 1, last + 1):
+        year, month = divmod(k * months + months - 1, 12)
+        month += 1
+        if period == "monthly":
+            label = "%04d-%02d" % (year, month)
+        elif period == "quarterly":
+            label = "%04d-Q%d" % (year, month // 3)
+        else:
+            label = "%04d" % year
+        result.append((label, "%04d-%02d-31" % (year, month)))
+    return result
+
+
+# Column-oriented storage for every post in the ledger.  Accounts,
+# commodities and descriptions are interned to small ids, dates are
+# YYYYMMDD ints and amounts are integers scaled by the number of decimal
+# places seen for their commodity, so a post costs a few array slots
+# rather than a list entry, two namedtuples and a Decimal.
+class PostingStore(object):
+
+    def __init__(self):
+        self.accountids = {}
+        self.accountnames = []
+        self.commodityids = {}
+        self.commoditynames = []
+        self.descriptionids = {}
+        self.descriptions = []
+
+        # Decimal places used by each commodity's scaled amounts, and the
+        # sum of their absolute values, which bounds every total of them
+        self.places = []
+        self.magnitude = []
+
+        # One entry per post
+        self.account = array.array('i')
+        self.commodity = array.array('i')
+        self.description = array.array('i')
+        self.date = array.array('i')
+        self.amount = array.array(INT64)
+
+        # Row numbers of each account's posts, in the order they were made
+        self.rows = []
+
+    def __len__(self):
+        return len(self.date)
+
+    def intern(self, ids, names, name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
+
+    def commodityid(self, commodity):
+        if commodity not in self.commodityids:
+            self.places.append(0)
+            self.magnitude.append(0)
+        return self.intern(self.commodityids, self.commoditynames, commodity)
+
+    def accountid(self, account):
+        if account not in self.accountids:
+            self.rows.append(array.array('i'))
+        return self.intern(self.accountids, self.accountnames, account)
+
+    # amount must already be scaled to the commodity's places
+    def add(self, account, date, description, c, amount):
+        self.addrow(self.accountid(account), datekey(date), description, c, amount)
+
+    # Like add(), for an account that already has id a and a date key
+    def addrow(self, a, key, description, c, amount):
+        d = self.intern(self.descriptionids, self.descriptions, description)
+
+        self.rows[a].append(len(self.date))
+        self.account.append(a)
+        self.commodity.append(c)
+        self.description.append(d)
+        self.date.append(key)
+        self.amount.append(amount)
+        self.magnitude[c] += abs(amount)
+
+    def thaw(self):
+        self.account = writable(self.account, 'i')
+        self.commodity = writable(self.commodity, 'i')
+        self.description = writable(self.description, 'i')
+        self.date = writable(self.date, 'i')
+        self.amount = writable(self.amount, INT64)
+        self.rows = [writable(rows, 'i') for rows in self.rows]
+
+    # Widens commodity c to more decimal places, rescaling its posts
+    def rescale(self, c, places):
+        factor = 10 ** (places - self.places[c])
+        for row in xrange(len(self.amount)):
+            if self.commodity[row] == c:
+                self.amount[row] *= factor
+        self.places[c] = places
+        self.magnitude[c] *= factor
+
+    # Converts a scaled amount of commodity c back to a Decimal
+    def value(self, c, amount):
+        return decimal.Decimal(amount).scaleb(-self.places[c])
+
+    # Returns (date, Entry) for a row
+    def entry(self, row):
+        c = self.commodity[row]
+        return datestr(self.date[row]), Entry(self.descriptions[self.description[row]], Amount(self.commoditynames[c], self.value(c, self.amount[row])))
+
+    # Row numbers of an account's posts in date order, parse order
+    # within a date
+    def sortedrows(self, account):
+        return sorted(self.rows[self.accountids[account]], key=self.date.__getitem__)
+
+
+# Every transaction in the ledger, in columns alongside a PostingStore:
+# its date key, description id in the store, file id, line, and the
+# range of store rows holding its posts.  Transaction namedtuples are
+# only built when asked for.  order holds transaction numbers sorted by
+# date, parse order within a date, with their date keys in orderdates.
+# It is extended while transactions arrive in date order, and rebuilt
+# the next time it is read after one arrives out of order.
+class TransactionIndex(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.fileids = {}
+        self.filenames = []
+
+        # One entry per transaction
+        self.date = array.array('i')
+        self.description = array.array('i')
+        self.filename = array.array('i')
+        self.linenum = array.array('i')
+        self.first = array.array('i')
+        self.stop = array.array('i')
+
+        self.order = array.array('i')
+        self.orderdates = array.array('i')
+
+    def __len__(self):
+        return len(self.date)
+
+    # Records a transaction whose posts are store rows first to stop
+    def add(self, transaction, first, stop):
+        store = self.store
+        key = datekey(transaction.date)
+        if len(self.order) == len(self.date) and (not self.orderdates or key >= self.orderdates[-1]):
+            self.order.append(len(self.date))
+            self.orderdates.append(key)
+        self.date.append(key)
+        self.description.append(store.intern(store.descriptionids, store.descriptions, transaction.description))
+        self.filename.append(store.intern(self.fileids, self.filenames, transaction.filename))
+        self.linenum.append(transaction.linenum)
+        self.first.append(first)
+        self.stop.append(stop)
+
+    # Brings order up to date
+    def sort(self):
+        if len(self.order) != len(self.date):
+            self.order = array.array('i', sorted(xrange(len(self.date)), key=self.date.__getitem__))
+            self.orderdates = array.array('i', [self.date[t] for t in self.order])
+
+    def thaw(self):
+        for name in ("date", "description", "filename", "linenum", "first", "stop", "order", "orderdates"):
+            setattr(self, name, writable(getattr(self, name), 'i'))
+
+    # Numbers of the transactions dated from start to end inclusive, in
+    # date order and parse order within a date
+    def between(self, start=None, end=None):
+        self.sort()
+        i = bisect.bisect_left(self.orderdates, datekey(start)) if start is not None else 0
+        j = bisect.bisect_right(self.orderdates, datekey(end)) if end is not None else len(self.order)
+        return self.order[i:j]
+
+    def transaction(self, t):
+        return Transaction(datestr(self.date[t]), self.store.descriptions[self.description[t]], self.linenum[t], self.filenames[self.filename[t]])
+
+
+# A numpy view of a store column, which is already one if it came from
+# a snapshot
+def npcolumn(column):
+    if isinstance(column, array.array):
+        return numpy.frombuffer(column, dtype=column.typecode)
+    return column
+
+# Totals of every (account id, commodity id) pair over the posts dated
+# on or before each of ends, a sorted list of date keys, worked out with
+# numpy.  Yields {(account id, commodity id): scaled total} for each end,
+# leaving out pairs with no posts by then, as RunningTotal.asof() does.
+# Posts are sorted by pair and date once; each end then costs a single
+# searchsorted over all pairs.
+def cumulative(store, ends):
+    if len(store) == 0:
+        for end in ends:
+            yield {}
+        return
+
+    ncommodities = len(store.commoditynames)
+    date = npcolumn(store.date).astype(numpy.int64)
+    pair = npcolumn(store.account).astype(numpy.int64) * ncommodities + npcolumn(store.commodity)
+    amount = npcolumn(store.amount)
+
+    order = numpy.lexsort((date, pair))
+    pair = pair[order]
+    # Dates are below 10**8, so this orders by pair, then date
+    composite = pair * 100000000 + date[order]
+    total = numpy.concatenate(([0], numpy.cumsum(amount[order])))
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(pair)) + 1))
+    pairs = pair[starts]
+    keys = [(int(p) // ncommodities, int(p) % ncommodities) for p in pairs]
+
+    for end in ends:
+        stops = numpy.searchsorted(composite, pairs * 100000000 + end, side="right")
+        totals = (total[stops] - total[starts]).tolist()
+        yield dict((keys[i], totals[i]) for i in numpy.flatnonzero(stops > starts).tolist())
+
+
+# Resolves account text to the ids used by the PostingStore.  Raw text
+# from a post is looked up in the aliases once and the result cached, and
+# each id remembers its account's prefixes, the tree nodes for them and
+# its index entry, so posting to an account seen before does no string
+# splitting and prefix queries don't walk the tree.
+class AccountTable(object):
+
+    def __init__(self, store, tree, index, aliases):
+        self.store = store
+        self.tree = tree
+        self.index = index
+        self.aliases = aliases
+
+        # raw account text -> id, after aliasing
+        self.resolved = {}
+
+        # One entry per id: "A", "A:B", "A:B:C" for account A:B:C, the
+        # AccountNode for each of those, and commodity -> RunningTotal
+        self.prefixes = []
+        self.paths = []
+        self.totals = []
+
+        # prefix -> AccountNode
+        self.nodes = {}
+
+    def alias(self, alias, account):
+        self.aliases[alias] = account
+        self.resolved.pop(alias, None)
+
+    # Id of the account a post naming raw refers to
+    def resolve(self, raw):
+        a = self.resolved.get(raw)
+        if a is None:
+            a = self.id(self.aliases.get(raw, raw))
+            self.resolved[raw] = a
+        return a
+
+    # Id of an account, adding it to the store and tree if it is new
+    def id(self, account):
+        a = self.store.accountids.get(account)
+        if a is not None:
+            return a
+
+        a = self.store.accountid(account)
+        self.add(account)
+        return a
+
+    # Fills in the entries for the store's next account id.  The tree
+    # nodes and index entry are reused if they exist already, as they do
+    # in a snapshot
+    def add(self, account):
+        prefixes = []
+        path = []
+        node = self.tree
+        for segment in account.split(":"):
+            prefixes.append(prefixes[-1] + ":" + segment if prefixes else segment)
+            if segment not in node.children:
+                node.children[segment] = AccountNode()
+            node = node.children[segment]
+            path.append(node)
+            self.nodes[prefixes[-1]] = node
+        node.account = account
+
+        self.prefixes.append(prefixes)
+        self.paths.append(path)
+        self.totals.append(self.index.setdefault(account, {}))
+
+    # The tree node for an account prefix, or None if nothing has been
+    # posted at or below it
+    def node(self, prefix):
+        return self.nodes.get(prefix)
+
+    # Parent prefix of an account or prefix, or None at the top level
+    def parent(self, prefix):
+        i = prefix.rfind(":")
+        return prefix[:i] if i >= 0 else None
+
+    # Full names of the prefixes directly below one
+    def children(self, prefix):
+        node = self.node(prefix)
+        if node is None:
+            return []
+        return [prefix + ":" + segment for segment in sorted(node.children)]
+
+
+# Timings gathered while parsing when a Ledger is created with
+# profile=True.  Each directive's time covers tokenizing and applying
+# its record; a file's time and an include's time leave out the files it
+# pulls in, which are counted under their own name.
+class Profile(object):
+
+    # How many of the slowest assertions to keep
+    SLOWEST = 10
+
+    def __init__(self):
+        # kind -> [count, seconds]
+        self.directives = {}
+        # filename -> seconds
+        self.files = {}
+        # heap of (seconds, filename, linenum)
+        self.assertions = []
+        # Time spent in files included from each file being applied
+        self.nested = [0.0]
+
+    def add(self, kind, seconds):
+        entry = self.directives.setdefault(kind, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def assertion(self, assertion, seconds):
+        heapq.heappush(self.assertions, (seconds, assertion.filename, assertion.linenum))
+        if len(self.assertions) > self.SLOWEST:
+            heapq.heappop(self.assertions)
+
+    # Passes records through, timing each one until the next is asked for
+    def records(self, records, filename):
+        self.nested.append(0.0)
+        total = 0.0
+        try:
+            start = time.time()
+            for record in records:
+                kind = record[0] if record[0] != "assert" else "assert " + record[1]
+                nested = self.nested[-1]
+                yield record
+                end = time.time()
+                self.add(kind, end - start - (self.nested[-1] - nested))
+                total += end - start
+                start = end
+        finally:
+            nested = self.nested.pop()
+            self.nested[-1] += total
+            self.files[filename] = self.files.get(filename, 0.0) + total - nested
+
+    def table(self):
+        lines = ["%-40s %10s %10s" % ("Directive", "Count", "Seconds")]
+        for kind, (count, seconds) in sorted(self.directives.items(), key=lambda i: -i[1][1]):
+            lines.append("%-40s %10d %10.4f" % (kind, count, seconds))
+        lines.append("")
+        lines.append("%-51s %10s" % ("File", "Seconds"))
+        for filename, seconds in sorted(self.files.items(), key=lambda i: -i[1]):
+            lines.append("%-51s %10.4f" % (filename, seconds))
+        if self.assertions:
+            lines.append("")
+            lines.append("%-51s %10s" % ("Slowest assertions", "Seconds"))
+            for seconds, filename, linenum in sorted(self.assertions, reverse=True):
+                lines.append("%-51s %10.4f" % ("%s:%s" % (filename, linenum), seconds))
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        return {
+            "directives": dict((kind, {"count": count, "seconds": seconds}) for (kind, (count, seconds)) in self.directives.items()),
+            "files": self.files,
+            "assertions": [{"filename": filename, "linenum": linenum, "seconds": seconds} for (seconds, filename, linenum) in sorted(self.assertions, reverse=True)],
+        }
+
+
+class Ledger(object):
+
+    # Every transaction and the store rows of its posts, see
+    # TransactionIndex
+    transactions = None
+    # account name -> id in store
+    accounts = {}
+    aliases = {}
+    commodities = set()
+
+    # Every post, see PostingStore
+    store = None
+
+    # account -> commodity -> RunningTotal
+    index = {}
+
+    # Root of the account hierarchy, see AccountNode
+    tree = None
+
+    # Account ids and prefixes, see AccountTable
+    symbols = None
+
+    # Commodity prices, see PriceTable
+    prices = None
+
+    # Assertions collected by parse() when deferred is set
+    pending_assertions = []
+
+    # AssertionError for each assertion the last check_assertions() found
+    # failing
+    failures = []
+
+    # Files whose assertions are skipped.  With deferred=True they are
+    # held in skipped instead, and checked after all if dated on or after
+    # the earliest transaction in a loaded file that is in neither
+    # unchecked nor unchanged, or changedfrom, the earliest date of
+    # transactions removed from the journal since they last passed.  A
+    # changed file with no transactions may hold aliases, buckets or
+    # includes that affect any date, so it has every assertion checked
+    unchecked = set()
+    unchanged = set()
+    changedfrom = None
+    skipped = []
+
+    # (Transaction, prefix, closing account, filename) of each closeall
+    # waiting for finish()
+    pending_closealls = []
+
+    # Latest post date seen, used to anchor undated deferred assertions
+    lastdate = None
+
+    # Number of records apply() has applied, and the latest date of any
+    # assertion checked and of any closeall made, see refresh()
+    applied = 0
+    checkedthrough = ""
+    closedthrough = ""
+
+    # Set while the columns are views of a snapshot's map, see
+    # load_snapshot()
+    mapped = False
+
+    # Timings collected while parsing, see Profile, or None
+    profile = None
+
+    # filename -> (Tokenized, error) tokenized ahead of time by prefetch()
+    prefetched = {}
+
+    # The file passed to load(), and a FileState for it and each file it
+    # included
+    root = None
+    files = {}
+
+    # Files being parsed, outermost first
+    including = []
+
+    # With deferred=True, assertions are collected while parsing and
+    # checked together once the top-level parse() finishes, so they also
+    # see transactions that appear later in the journal.  cache is a
+    # directory for a JournalCache, or None to always tokenize files from
+    # scratch.  profile=True collects timings in self.profile
+    def __init__(self, assertions=True, deferred=False, cache=None, profile=False):
+        self.assertions = assertions
+        self.deferred = deferred
+        self.cache = JournalCache(cache) if cache is not None else None
+        self.profile = Profile() if profile else None
+        self.unchecked = set()
+        self.unchanged = set()
+        self.changedfrom = None
+        self.root = None
+        self.reset()
+
+    # Forgets everything that has been parsed
+    def reset(self):
+        self.store = PostingStore()
+        self.transactions = TransactionIndex(self.store)
+        self.accounts = self.store.accountids
+        self.index = {}
+        self.tree = AccountNode()
+        self.aliases = {}
+        self.symbols = AccountTable(self.store, self.tree, self.index, self.aliases)
+        self.commodities = set()
+        self.prices = PriceTable()
+        self.pending_assertions = []
+        self.failures = []
+        self.skipped = []
+        self.pending_closealls = []
+        self.lastdate = None
+        self.applied = 0
+        self.checkedthrough = ""
+        self.closedthrough = ""
+        self.mapped = False
+        self.prefetched = {}
+        self.files = {}
+        self.including = []
+
+    def parseamount(self, amountstr, filename, linenum):
+        return parseamount(amountstr, filename, linenum)
+
+    # value is a Fixed; it is stored scaled to the commodity's places
+    def makepost(self, account,date,description,commodity,value):
+        self.post(self.symbols.id(account), date, description, commodity, value)
+
+    # Like makepost(), for an account id from self.symbols
+    def post(self, a, date, description, commodity, value):
+        if self.mapped:
+            self.thaw()
+        self.commodities.add(commodity)
+        if self.lastdate is None or date > self.lastdate:
+            self.lastdate = date
+        key = datekey(date)
+
+        c = self.store.commodityid(commodity)
+        if value.places > self.store.places[c]:
+            self.rescale(commodity, value.places)
+        value = rescaled(value, self.store.places[c])
+
+        self.store.addrow(a, key, description, c, value)
+
+        totals = self.symbols.totals[a]
+        if commodity not in totals:
+            totals[commodity] = RunningTotal()
+        totals[commodity].add(key, value)
+
+        for node in self.symbols.paths[a]:
+            node.add(key, commodity, value)
+
+    # Copies every column that is still a view of a snapshot's map into
+    # an array, before anything is added to them
+    def thaw(self):
+        self.store.thaw()
+        self.transactions.thaw()
+        for totals in self.index.values():
+            for total in totals.values():
+                total.thaw()
+        for node in self.symbols.nodes.values():
+            for total in node.totals.values():
+                total.thaw()
+        self.mapped = False
+
+    # Widens a commodity to more decimal places everywhere it is stored
+    def rescale(self, commodity, places):
+        c = self.store.commodityids[commodity]
+        factor = 10 ** (places - self.store.places[c])
+        self.store.rescale(c, places)
+        for totals in self.index.values():
+            if commodity in totals:
+                totals[commodity].scale(factor)
+        self.tree.scale(commodity, factor)
+
+    # Finds the tree node for an account prefix, or None if nothing has
+    # been posted at or below it
+    def node(self, prefix):
+        return self.symbols.node(prefix)
+
+
+    # Looks up the running total of each commodity in the index.  Dates
+    # compare lexically, so an asof like 2015-02-32 still works.  With
+    # start, only the change from start to asof is counted
+    def balance(self, account, asof=None, start=None):
 
         if account not in self.accounts:
             raise AccountNotFoundError(account)
 
+        return self.values(self.scaledbalance(account, asof, start))
+
+    # Like balance(), but as {commodity: scaled int}
+    def scaledbalance(self, account, asof=None, start=None):
         balances = {}
-        datekeys = self.accounts[account].keys()
-        datekeys.sort()
-        for date in datekeys:
-            # We assumd 2015-02-32 which will compare lexically
-            if asof is None or date <= asof:
-                for entry in self.accounts[account][date]:
-                    if entry.amount.commodity not in balances:
-                        balances[entry.amount.commodity] = decimal.Decimal(0)
-                    balances[entry.amount.commodity] += entry.amount.value
-            else:
-                break
+        for commodity, totals in self.index[account].items():
+            value = totals.asof(asof)
+            if value is not None:
+                if start is not None:
+                    value -= totals.before(start) or 0
+                balances[commodity] = value
         return balances
 
-    def balances(self, asof=None):
+    # Balance of each commodity posted to account before date
+    def opening(self, account, date):
+        balances = {}
+        for commodity, totals in self.index[account].items():
+            value = totals.before(date)
+            if value is not None:
+                balances[commodity] = value
+        return balances
+
+    def balances(self, asof=None, start=None):
         result = {}
         for account in self.accounts:
-            result[account] = self.balance(account, asof)
+            result[account] = self.balance(account, asof, start)
         return result
 
-    # Fetches the balance of all sub-accounts that have this name as
-    # a prefix
-    def balance_children(self, prefix, asof=None):
-        b = self.balances(asof)
-        result = {}
-        for account in [i for i in self.accounts if i.startswith(prefix)]:
-            for commodity in b[account]:
-                if commodity not in result:
-                    result[commodity] = decimal.Decimal(0)
-                result[commodity] += b[account][commodity]
-        return result
+    # Fetches the combined balance of this account and all of its
+    # sub-accounts.  Matching is by whole segments, so Assets:Bank does
+    # not include Assets:Bank2
+    def balance_children(self, prefix, asof=None, start=None):
+        node = self.node(prefix)
+        if node is None:
+            return {}
+        return self.values(node.balance(asof, start))
+
+    # Yields (Transaction, [Post]) for each transaction dated from start
+    # to end inclusive, with the posts as made, balancing post included.
+    # Each post carries the file and line of its transaction
+    def transactions_between(self, start=None, end=None):
+        store = self.store
+        index = self.transactions
+        for t in index.between(start, end):
+            transaction = index.transaction(t)
+            posts = []
+            for row in xrange(index.first[t], index.stop[t]):
+                c = store.commodity[row]
+                amount = Amount(store.commoditynames[c], store.value(c, store.amount[row]))
+                posts.append(Post(store.accountnames[store.account[row]], amount, transaction.filename, transaction.linenum))
+            yield transaction, posts
 
     def commodities(self):
         return self.commodities
 
+    # Yields a RegisterRow for every post to account (and its
+    # sub-accounts, or every account if None) dated between start and
+    # end inclusive, in date order.  The per-account post lists are
+    # merged lazily, so rows are produced as soon as they are known.
+    # Running balances still include posts from before start.
+    def register(self, account=None, start=None, end=None):
+        if account is None:
+            accounts = self.accounts.keys()
+        else:
+            node = self.node(account)
+            accounts = list(node.accounts()) if node is not None else []
+
+        if start is not None:
+            return self.rangeregister(accounts, start, end)
+        return self.fullregister(accounts, end)
+
+    # register() from the start of the ledger
+    def fullregister(self, accounts, end):
+        store = self.store
+        end = datekey(end) if end is not None else None
+
+        def posts(account):
+            for i, row in enumerate(store.sortedrows(account)):
+                yield store.date[row], account, i, row
+
+        balances = dict((a, {}) for a in accounts)
+        for date, account, i, row in heapq.merge(*[posts(a) for a in sorted(accounts)]):
+            if end is not None and date > end:
+                break
+            balance = balances[account]
+            c = store.commodity[row]
+            balance[c] = balance.get(c, 0) + store.amount[row]
+            yield RegisterRow(datestr(date), account, store.commoditynames[c], store.value(c, store.amount[row]), store.value(c, balance[c]), store.descriptions[store.description[row]])
+
+    # register() for posts from start on, found through the transaction
+    # index.  Running balances start from the index's balance before start
+    def rangeregister(self, accounts, start, end):
+        store = self.store
+        ids = set(self.accounts[account] for account in accounts)
+        index = self.transactions
+        rows = [row for t in index.between(start, end) for row in xrange(index.first[t], index.stop[t]) if store.account[row] in ids]
+        # Same order as fullregister(): rows are already in date and then
+        # parse order, and the sort is stable
+        rows.sort(key=lambda row: (store.date[row], store.accountnames[store.account[row]]))
+
+        balances = {}
+        for row in rows:
+            a = store.account[row]
+            if a not in balances:
+                opening = self.opening(store.accountnames[a], start)
+                balances[a] = dict((store.commodityids[commodity], value) for (commodity, value) in opening.items())
+            balance = balances[a]
+            c = store.commodity[row]
+            balance[c] = balance.get(c, 0) + store.amount[row]
+            yield RegisterRow(datestr(store.date[row]), store.accountnames[a], store.commoditynames[c], store.value(c, store.amount[row]), store.value(c, balance[c]), store.descriptions[store.description[row]])
+
+    # Walks every post in date order and yields (date, running, own) at
+    # each of the given dates.  running maps every account and parent
+    # account prefix to {commodity: scaled amount} as of that date, see
+    # PostingStore, and own maps each account to the balance of its own
+    # posts only.  Both are updated in place as the sweep continues, so
+    # copy anything you need to keep.
+    def sweep(self, dates):
+        if numpy is not None:
+            return self.npsweep(dates)
+        return self.pysweep(dates)
+
+    def pysweep(self, dates):
+        store = self.store
+        prefixes = self.symbols.prefixes
+        order = sorted(xrange(len(store)), key=store.date.__getitem__)
+
+        running = {}
+        own = {}
+        i = 0
+        for date in sorted(dates):
+            key = datekey(date)
+            while i < len(order) and store.date[order[i]] <= key:
+                row = order[i]
+                c = store.commoditynames[store.commodity[row]]
+                amount = store.amount[row]
+                for prefix in prefixes[store.account[row]]:
+                    if prefix not in running:
+                        running[prefix] = {}
+                    balance = running[prefix]
+                    balance[c] = balance.get(c, 0) + amount
+                balance = own.setdefault(store.accountnames[store.account[row]], {})
+                balance[c] = balance.get(c, 0) + amount
+                i += 1
+            yield date, running, own
+
+    # sweep() using cumulative(), building fresh dicts for each date
+    def npsweep(self, dates):
+        store = self.store
+        prefixes = self.symbols.prefixes
+        dates = sorted(dates)
+        for date, totals in zip(dates, cumulative(store, [datekey(date) for date in dates])):
+            running = {}
+            own = {}
+            for (a, c), amount in totals.iteritems():
+                commodity = store.commoditynames[c]
+                own.setdefault(store.accountnames[a], {})[commodity] = amount
+                for prefix in prefixes[a]:
+                    balance = running.setdefault(prefix, {})
+                    balance[commodity] = balance.get(commodity, 0) + amount
+            yield date, running, own
+
+    # Balances at the end of each period between start and end, and how
+    # much they changed over each period, from a single sweep.  period
+    # is one of PERIODS.  With rollup=True every parent account prefix is
+    # included too, with the totals of the accounts below it
+    def periodic(self, period="monthly", start=None, end=None, rollup=False):
+        start = start or self.startdate()
+        end = end or self.enddate()
+        # An empty ledger, or an end before the first period, has no
+        # periods to report
+        if start is None or end is None:
+            return PeriodTable([], {}, {})
+        ends = periodends(period, start, end)
+        if len(ends) < 2:
+            return PeriodTable([], {}, {})
+
+        labels, dates = zip(*ends)
+        count = len(labels) - 1
+        ids = self.store.commodityids
+        opening = {}
+        balances = {}
+        for i, (date, running, own) in enumerate(self.sweep(dates)):
+            for account, balance in (running if rollup else own).iteritems():
+                for commodity, amount in balance.iteritems():
+                    if i == 0:
+                        opening[(account, commodity)] = amount
+                        continue
+                    series = balances.setdefault(account, {})
+                    if commodity not in series:
+                        series[commodity] = [0] * count
+                    series[commodity][i-1] = amount
+
+        deltas = {}
+        for account, series in balances.iteritems():
+            for commodity, amounts in series.iteritems():
+                c = ids[commodity]
+                previous = [opening.get((account, commodity), 0)] + amounts[:-1]
+                deltas.setdefault(account, {})[commodity] = [self.store.value(c, b - a) for (a, b) in zip(previous, amounts)]
+                series[commodity] = [self.store.value(c, amount) for amount in amounts]
+        return PeriodTable(list(labels[1:]), balances, deltas)
+
+    # Price of one unit of commodity in currency as of asof, see
+    # PriceTable.  Raises PriceNotFoundError if there is none
+    def price(self, commodity, currency, asof=None):
+        price = self.prices.price(commodity, currency, asof)
+        if price is None:
+            raise PriceNotFoundError(commodity, currency, asof)
+        return price
+
+    # Values a {commodity: Decimal} balance, as from balance(), in
+    # currency at the prices as of asof
+    def value(self, balance, currency, asof=None):
+        total = decimal.Decimal(0)
+        for commodity, amount in balance.items():
+            if amount != 0:
+                total += amount * self.price(commodity, currency, asof)
+        return total
+
+    # Converts a {commodity: scaled amount} balance to the
+    # {commodity: Decimal} form returned by balance()
+    def values(self, balance):
+        ids = self.store.commodityids
+        return dict((commodity, self.store.value(ids[commodity], amount)) for commodity, amount in balance.items())
+
+    # Raises AssertionError if the assertion does not hold.  balance_children
+    # is called as balance_children(prefix, asof) to get rollup balances
+    def checkassertion(self, assertion, balance_children):
+        if assertion.kind == "balance":
+            balance = balance_children(assertion.accounts[0], assertion.asof)
+            amount = Amount(assertion.amount.commodity, fixedvalue(assertion.amount.value))
+
+            if not (amount.value == 0 and amount.commodity not in balance) and \
+                (amount.commodity not in balance or balance[amount.commodity] != amount.value):
+                raise AssertionError(assertion.filename, assertion.linenum, "Account %s actual balance of %s on %s does not match assertion value %s" % (assertion.accounts[0], repr(balance), assertion.asof, repr(amount)))
+
+        elif assertion.kind == "equation":
+            data = {}
+            for acct, account in zip(["assets","liabilities","equity","income","expense"], assertion.accounts):
+                data[acct] = balance_children(account, assertion.asof)
+
+
+            # Assets + liabilities
+            left = {}
+            right = {}
+            for commodity in self.commodities:
+                left[commodity] = decimal.Decimal(0)
+                right[commodity] = decimal.Decimal(0)
+
+                # Left
+                if commodity in data["assets"]:
+                    left[commodity] += data["assets"][commodity]
+                if commodity in data["liabilities"]:
+                    left[commodity] += data["liabilities"][commodity]
+
+                # Right
+                if commodity in data["equity"]:
+                    right[commodity] -= data["equity"][commodity]
+                if commodity in data["income"]:
+                    right[commodity] -= data["income"][commodity]
+                if commodity in data["expense"]:
+                    right[commodity] -= data["expense"][commodity]
+
+
+
+            if left != right:
+                print data
+                raise AssertionError(assertion.filename, assertion.linenum, "Accounting equation not satisified: %s != %s" % (repr(left), repr(right)))
+
+    # Checks every pending assertion in one date-ordered sweep.  Every
+    # failure is kept in self.failures, in date order, and the earliest
+    # dated one is raised
+    def check_assertions(self):
+        start = time.time()
+        assertions = self.pending_assertions
+        if self.skipped:
+            first = self.firstdates()
+            changed = [first.get(filename, "0000-00-00") for filename in self.files
+                       if filename not in self.unchecked and filename not in self.unchanged]
+            if self.changedfrom is not None:
+                changed.append(self.changedfrom)
+            if changed:
+                assertions = assertions + [a for a in self.skipped if a.asof >= min(changed)]
+            self.skipped = []
+        assertions = sorted(assertions, key=lambda a: a.asof)
+        self.pending_assertions = []
+        self.failures = []
+        i = 0
+        for date, running, own in self.sweep(set(a.asof for a in assertions)):
+            lookup = lambda prefix, asof: self.values(running.get(prefix, {}))
+            while i < len(assertions) and assertions[i].asof == date:
+                try:
+                    self.check(assertions[i], lookup)
+                except AssertionError as e:
+                    self.failures.append(e)
+                i += 1
+        if self.profile is not None:
+            self.profile.add("deferred assertions", time.time() - start)
+        if self.failures:
+            raise self.failures[0]
+
+    # checkassertion(), timed when profiling
+    def check(self, assertion, balance_children):
+        if assertion.asof > self.checkedthrough:
+            self.checkedthrough = assertion.asof
+        if self.profile is None:
+            return self.checkassertion(assertion, balance_children)
+        start = time.time()
+        try:
+            self.checkassertion(assertion, balance_children)
+        finally:
+            self.profile.assertion(assertion, time.time() - start)
+
+    def assertion(self, assertion):
+        if self.deferred:
+            if assertion.asof is None:
+                # Undated assertions cover everything seen so far
+                assertion = assertion._replace(asof=self.lastdate or "0000-00-00")
+            if assertion.filename in self.unchecked:
+                self.skipped.append(assertion)
+            else:
+                self.pending_assertions.append(assertion)
+        elif assertion.filename not in self.unchecked:
+            # Balances are only final once the closealls before this
+            # have been made
+            self.closeall()
+            self.check(assertion, self.balance_children)
+
     def startdate(self):
-        start = None
-        for account in self.accounts:
-            datekeys = self.accounts[account].keys()
-            datekeys.sort()
-            if start is None or start > datekeys[0]:
-                start = datekeys[0]
-        return start
+        if len(self.store) == 0:
+            return None
+        return datestr(min(self.store.date))
 
     def enddate(self):
-        start = None
-        for account in self.accounts:
-            datekeys = self.accounts[account].keys()
-            datekeys.sort()
-            if start < datekeys[-1]:
-                start = datekeys[-1]
-        return start
-
+        if len(self.store) == 0:
+            return None
+        return datestr(max(self.store.date))
+
+
+    # filename -> date of the earliest transaction in it
+    def firstdates(self):
+        index = self.transactions
+        first = {}
+        for t in xrange(len(index)):
+            f = index.filename[t]
+            if f not in first or index.date[t] < first[f]:
+                first[f] = index.date[t]
+        return dict((index.filenames[f], datestr(key)) for (f, key) in first.items())
+
+    # Raises ParseError, before anything is posted, if a transaction's
+    # amounts could take a total of their commodity, or its amounts once
+    # rescaled to more places, out of the range of the int64 columns
+    def checkrange(self, transaction, posts):
+        values = {}
+        for post in posts:
+            if post.amount is not None and post.amount.value is not None:
+                values.setdefault(post.amount.commodity, []).append(post.amount.value)
+        store = self.store
+        for commodity, fixeds in values.items():
+            c = store.commodityids.get(commodity)
+            current = store.places[c] if c is not None else 0
+            places = max([current] + [fixed.places for fixed in fixeds])
+            magnitude = store.magnitude[c] * 10 ** (places - current) if c is not None else 0
+            # Each value is posted, and balanced by a post of at most the
+            # same size
+            magnitude += 2 * sum(abs(rescaled(fixed, places)) for fixed in fixeds)
+            if magnitude > INT64_MAX:
+                raise ParseError(transaction.filename, transaction.linenum, "Amounts of %s are too large to store with %d decimal places" % (commodity, places))
 
     def maketransaction(self, transaction, posts, bucket = None):
+        self.checkrange(transaction, posts)
+        first = len(self.store)
         balanceaccount = bucket
         values = {}
         if len(posts) == 0 or len(posts) == 1 and posts[0].amount.commodity is None:
             raise ParseError(transaction.filename, transaction.linenum, "No transactions")
 
         for post in posts:
-            account = post.account
-            if account in self.aliases:
-                account = self.aliases[post.account]
             if post.amount is None or post.amount.value is None:
                 if balanceaccount is None or balanceaccount == bucket:
-                    balanceaccount = account
+                    balanceaccount = self.aliases.get(post.account, post.account)
                 else:
                     raise ParseError(post.filename, post.linenum, "Cannot have multiple empty posts")
             else:
                 if post.amount.commodity not in values:
-                    values[post.amount.commodity] = 0
+                    values[post.amount.commodity] = Fixed(0, 0)
 
-                values[post.amount.commodity] += post.amount.value
+                values[post.amount.commodity] = addfixed(values[post.amount.commodity], post.amount.value)
 
-                self.makepost(account, transaction.date, transaction.description, post.amount.commodity, post.amount.value)
+                self.post(self.symbols.resolve(post.account), transaction.date, transaction.description, post.amount.commodity, post.amount.value)
 
         for commodity in values:
-            if values[commodity] != decimal.Decimal("0"):
+            if values[commodity].units != 0:
                 if balanceaccount is not None:
-                    self.makepost(balanceaccount, transaction.date, transaction.description, commodity, -values[commodity])
+                    self.makepost(balanceaccount, transaction.date, transaction.description, commodity, Fixed(-values[commodity].units, values[commodity].places))
                 else:
-                    raise ParseError(post.filename, post.linenum, "Transaction does not balance: %f %s outstanding" % (values[commodity], commodity))
+                    raise ParseError(post.filename, post.linenum, "Transaction does not balance: %f %s outstanding" % (fixedvalue(values[commodity]), commodity))
 
-    # Parses a file, can be called recursively
-    def parse(self, reader,filename=None):
+        self.transactions.add(transaction, first, len(self.store))
 
-        bucket = None
-        transaction = None
-        accountdef = None
-        posts = []
-        for linenum, line in enumerate(reader):
-            linenum += 1
+    # Parses a journal.  Deferred assertions are checked once it has
+    # been read, including any included files
+    def parse(self, reader,filename=None):
+        self.apply(tokenize(reader, filename), filename)
+        self.finish()
+
+    # Resolves what had to wait for the whole journal, once parse(),
+    # load() or refresh() has applied everything
+    def finish(self):
+        self.closeall()
+        if self.deferred:
+            self.check_assertions()
+
+    # Makes the closing transaction for each pending closeall, in date
+    # order and parse order within a date, so each one sees every post
+    # dated up to it however late it appeared in the journal, including
+    # those made by earlier closealls
+    def closeall(self):
+        start = time.time()
+        closealls = sorted(self.pending_closealls, key=lambda c: c[0].date)
+        self.pending_closealls = []
+        for transaction, prefix, closingaccount, filename in closealls:
+            posts = []
+            node = self.node(prefix)
+            for account in (node.accounts() if node is not None else []):
+                balance = self.scaledbalance(account,transaction.date)
+                for commodity,value in balance.items():
+                    places = self.store.places[self.store.commodityids[commodity]]
+                    posts.append(Post(account,Amount(commodity,Fixed(-value, places)),filename,transaction.linenum))
+
+            self.maketransaction(transaction, posts, closingaccount)
+            self.closedthrough = max(self.closedthrough, transaction.date)
+        if self.profile is not None and closealls:
+            self.profile.add("deferred closeall", time.time() - start)
+
+    # Loads a journal file by name, going through the cache if enabled.
+    # With jobs > 1 the file and everything it includes are tokenized in
+    # that many worker processes first, or threads with threads=True,
+    # then applied in include order
+    def load(self, filename, jobs=None, threads=False):
+        self.root = filename
+        if jobs is not None and jobs > 1:
+            self.prefetch(filename, jobs, threads)
+        try:
+            self.parsefile(filename)
+        finally:
+            self.prefetched = {}
+        self.finish()
+
+    # Starts load() with threads=True in a background thread and
+    # returns its AsyncResult, whose get() waits for the load and raises
+    # anything it raised.  The ledger must be left alone until then
+    def load_async(self, filename, jobs=8):
+        pool = multiprocessing.pool.ThreadPool(1)
+        result = pool.apply_async(self.load, (filename, jobs, True))
+        pool.close()
+        # A pool can't be joined from its own threads, where a completion
+        # callback runs, so a watcher joins it once the load has finished,
+        # whether or not it failed
+        watcher = threading.Thread(target=pool.join)
+        watcher.daemon = True
+        watcher.start()
+        return result
 
-            line = line.rstrip()
-            m = re.match(" *;", line)
-            if line == '' or m:
+    # Tokenizes filename and every file it includes with at most jobs
+    # files in flight.  Each include is queued as soon as the file naming
+    # it has been tokenized, rather than waiting for the rest of its level
+    def prefetch(self, filename, jobs, threads=False):
+        cachedir = self.cache.directory if self.cache is not None else None
+        if threads:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+        else:
+            pool = multiprocessing.Pool(jobs)
+        worker = tokenizefile
+        try:
+            seen = set([filename])
+            pending = deque([(filename, pool.apply_async(worker, [(filename, cachedir)]))])
+            while pending:
+                f, result = pending.popleft()
+                result = self.prefetched[f] = result.get()
+                for record in (result[0].records if result[0] is not None else []):
+                    if record[0] == "include" and record[1] not in seen:
+                        seen.add(record[1])
+                        pending.append((record[1], pool.apply_async(worker, [(record[1], cachedir)])))
+        finally:
+            pool.close()
+            pool.join()
+
+    def parsefile(self, filename):
+        if filename in self.prefetched:
+            tokenized, error = self.prefetched[filename]
+            if error is not None:
+                raise error
+        elif self.cache is not None:
+            tokenized = self.cache.tokenized(filename)
+        else:
+            tokenized = StreamedFile(filename)
+        parents = tuple(self.including)
+        self.including.append(filename)
+        try:
+            bucket = self.apply(tokenized.records, filename)
+        finally:
+            self.including.pop()
+        self.files[filename] = FileState(tokenized.size, tokenized.mtime, tokenized.digest, bucket, self.applied, parents)
+
+    # Applies whatever has been appended to the loaded files since they
+    # were parsed, continuing each with the bucket it ended with.  This
+    # only happens when the result is the same as loading the journal
+    # again: the new text must be the last thing a fresh load would
+    # apply, so nothing was applied after the end of its file, and it
+    # must be dated after every assertion already checked and every
+    # closeall already made, which it would change.  Otherwise,
+    # or if a file changed in any other way, more than one file grew or
+    # the new text continues the last transaction or account block,
+    # everything is reloaded instead.  Returns True if anything changed.
+    def refresh(self):
+        appended = []
+        for filename, state in self.files.items():
+            st = os.stat(filename)
+            if st.st_size == state.offset and st.st_mtime == state.mtime:
                 continue
-
-
-            if transaction is not None:
-                m = re.match("^\s+(?P<account>.*?)(\s\s+(?P<amount>.*))?$", line)
-                if m:
-                    amount = None
-                    if m.group("amount") is not None:
-                        amount = self.parseamount(m.group("amount"),filename,linenum)
-                    post = Post(m.group("account"),amount,filename,linenum)
-                    posts.append(post)
+            # The text already applied is hashed a chunk at a time, and
+            # only the new text is held in memory
+            sha = hashlib.sha1()
+            linenum = 1
+            last = "\n"
+            with open(filename, "rb") as f:
+                remaining = state.offset
+                while remaining:
+                    chunk = f.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        return self.reload()
+                    sha.update(chunk)
+                    linenum += chunk.count("\n")
+                    last = chunk[-1]
+                    remaining -= len(chunk)
+                tail = f.read()
+            if sha.hexdigest() != state.digest or last != "\n":
+                return self.reload()
+
+            if not tail:
+                self.files[filename] = state._replace(mtime=st.st_mtime)
+                continue
+            for line in cStringIO.StringIO(tail):
+                if line.strip() == '' or line.lstrip(" ")[:1] == ";":
                     continue
+                if line[0].isspace():
+                    return self.reload()
+                break
+            sha.update(tail)
+            records = list(tokenize(cStringIO.StringIO(tail), filename, linenum))
+            appended.append((filename, state, records, st.st_mtime, sha.hexdigest(), state.offset + len(tail)))
+
+        if len(appended) > 1:
+            return self.reload()
+        for filename, state, records, mtime, digest, size in appended:
+            if state.applied != self.applied:
+                return self.reload()
+            earliest = self.earliest(records)
+            if earliest is not None and earliest <= max(self.checkedthrough, self.closedthrough):
+                return self.reload()
+
+        for filename, state, records, mtime, digest, size in appended:
+            try:
+                bucket = self.apply(records, filename, state.bucket)
+            except:
+                # Part of the tail may have been applied, so make the
+                # next refresh() start over
+                self.files[filename] = state._replace(digest=None)
+                raise
+            # The files that include this one, and ended right after it,
+            # now end after the new text too.  Files it included end
+            # where they did
+            for parent in state.parents:
+                if self.files[parent].applied == state.applied:
+                    self.files[parent] = self.files[parent]._replace(applied=self.applied)
+            self.files[filename] = FileState(size, mtime, digest, bucket, self.applied, state.parents)
+        if appended:
+            self.finish()
+        return len(appended) > 0
+
+    # Earliest date anything in records posts on, or None if they post
+    # nothing.  An included file could post on any date
+    def earliest(self, records):
+        dates = []
+        for record in records:
+            if record[0] in ("transaction", "closeall"):
+                dates.append(record[1].date)
+            elif record[0] == "include":
+                dates.append("0000-00-00")
+        return min(dates) if dates else None
+
+    def reload(self):
+        self.reset()
+        self.load(self.root)
+        return True
+
+    # Writes everything that has been loaded to a snapshot file, see
+    # SNAPSHOT_MAGIC, for load_snapshot() to read back without parsing
+    def save_snapshot(self, path):
+        store = self.store
+        index = self.transactions
+        index.sort()
+        rows = array.array('i')
+        for r in store.rows:
+            rows.extend(writable(r, 'i'))
+
+        # (kind, account or prefix, commodity, start, count) of each
+        # RunningTotal's entries in the totaldates and totalvalues columns
+        totals = []
+        totaldates = array.array('i')
+        totalvalues = array.array(INT64)
+        owners = [("index", account, table) for (account, table) in self.index.items()] + \
+            [("tree", prefix, node.totals) for (prefix, node) in self.symbols.nodes.items()]
+        for kind, name, table in owners:
+            for commodity, total in table.items():
+                if total.pendingdates:
+                    total.merge()
+                totals.append((kind, name, commodity, len(totaldates), len(total.dates)))
+                totaldates.extend(writable(total.dates, 'i'))
+                totalvalues.extend(writable(total.totals, INT64))
+
+        metadata = {
+            "byteorder": sys.byteorder,
+            "columns": {},
+            "accountnames": store.accountnames,
+            "commoditynames": store.commoditynames,
+            "places": store.places,
+            "magnitude": store.magnitude,
+            "rowcounts": [len(r) for r in store.rows],
+            "totals": totals,
+            "filenames": index.filenames,
+            "aliases": self.aliases,
+            "commodities": list(self.commodities),
+            "prices": (self.prices.dates, self.prices.prices),
+            "lastdate": self.lastdate,
+            "applied": self.applied,
+            "checkedthrough": self.checkedthrough,
+            "closedthrough": self.closedthrough,
+            "root": self.root,
+            "files": dict((filename, tuple(state)) for (filename, state) in self.files.items()),
+        }
+        columns = [("account", 'i', store.account), ("commodity", 'i', store.commodity), ("description", 'i', store.description),
+                   ("date", 'i', store.date), ("amount", INT64, store.amount), ("rows", 'i', rows),
+                   ("totaldates", 'i', totaldates), ("totalvalues", INT64, totalvalues)]
+        for name in ("date", "description", "filename", "linenum", "first", "stop", "order", "orderdates"):
+            columns.append(("transaction" + name, 'i', getattr(index, name)))
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack("<I", SNAPSHOT_VERSION))
+            for name, typecode, column in columns:
+                f.write("\0" * (-f.tell() % 8))
+                metadata["columns"][name] = (typecode, array.array(typecode).itemsize, f.tell(), len(column))
+                f.write(column.tostring())
+            descriptions = "\n".join(store.descriptions)
+            metadata["descriptions"] = (f.tell(), len(descriptions), len(store.descriptions))
+            f.write(descriptions)
+            offset = f.tell()
+            cPickle.dump(metadata, f, cPickle.HIGHEST_PROTOCOL)
+            f.write(struct.pack("<Q", offset))
+        os.rename(tmp, path)
+
+    # Replaces whatever is loaded with a snapshot from save_snapshot().
+    # With numpy the columns are read-only views of a map of the file,
+    # so nothing is copied until thaw() is needed to add to them, and
+    # the map stays open as long as they do.  Without numpy each column
+    # is copied out in one piece.  The ledger can go on to parse more
+    # journal text
+    def load_snapshot(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise SnapshotError(path, "Not a snapshot")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        shared = False
+        try:
+            header = len(SNAPSHOT_MAGIC) + 4
+            if len(mm) < header + 8 or mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise SnapshotError(path, "Not a snapshot")
+            version, = struct.unpack("<I", mm[len(SNAPSHOT_MAGIC):header])
+            if version != SNAPSHOT_VERSION:
+                raise SnapshotError(path, "Snapshot version %d, expected %d" % (version, SNAPSHOT_VERSION))
+            offset, = struct.unpack("<Q", mm[-8:])
+            metadata = cPickle.loads(mm[offset:-8])
+            if metadata["byteorder"] != sys.byteorder:
+                raise SnapshotError(path, "Snapshot is %s endian" % metadata["byteorder"])
+
+            columns = {}
+            for name, (typecode, itemsize, start, count) in metadata["columns"].items():
+                if array.array(typecode).itemsize != itemsize:
+                    raise SnapshotError(path, "Snapshot has %d byte '%s' values" % (itemsize, typecode))
+                if numpy is not None:
+                    column = numpy.frombuffer(mm, dtype=typecode, count=count, offset=start)
+                else:
+                    column = array.array(typecode)
+                    column.fromstring(mm[start:start + itemsize * count])
+                columns[name] = column
+            start, length, count = metadata["descriptions"]
+            descriptions = mm[start:start + length].split("\n") if count else []
+            shared = numpy is not None
+        finally:
+            if not shared:
+                mm.close()
+
+        self.reset()
+        self.mapped = shared
+        store = self.store
+        store.account = columns["account"]
+        store.commodity = columns["commodity"]
+        store.description = columns["description"]
+        store.date = columns["date"]
+        store.amount = columns["amount"]
+        start = 0
+        for count in metadata["rowcounts"]:
+            store.rows.append(columns["rows"][start:start + count])
+            start += count
+        for ids, names, table in [(store.accountids, store.accountnames, metadata["accountnames"]),
+                                  (store.commodityids, store.commoditynames, metadata["commoditynames"]),
+                                  (store.descriptionids, store.descriptions, descriptions)]:
+            names.extend(table)
+            ids.update((name, i) for (i, name) in enumerate(table))
+        store.places = metadata["places"]
+        store.magnitude = metadata["magnitude"]
+
+        # The index entries come first, so AccountTable.add() finds them,
+        # and the tree's after, once it has made the nodes
+        tree = []
+        for kind, name, commodity, start, count in metadata["totals"]:
+            total = RunningTotal()
+            total.dates = columns["totaldates"][start:start + count]
+            total.totals = columns["totalvalues"][start:start + count]
+            if kind == "index":
+                self.index.setdefault(name, {})[commodity] = total
+            else:
+                tree.append((name, commodity, total))
+        for account in store.accountnames:
+            self.symbols.add(account)
+        for prefix, commodity, total in tree:
+            self.symbols.nodes[prefix].totals[commodity] = total
+
+        index = self.transactions
+        for name in ("date", "description", "filename", "linenum", "first", "stop", "order", "orderdates"):
+            setattr(index, name, columns["transaction" + name])
+        index.filenames.extend(metadata["filenames"])
+        index.fileids.update((filename, i) for (i, filename) in enumerate(index.filenames))
+
+        self.aliases.update(metadata["aliases"])
+        self.commodities.update(metadata["commodities"])
+        self.prices.dates, self.prices.prices = metadata["prices"]
+        self.lastdate = metadata["lastdate"]
+        self.applied = metadata["applied"]
+        self.checkedthrough = metadata["checkedthrough"]
+        self.closedthrough = metadata["closedthrough"]
+        self.root = metadata["root"]
+        self.files = dict((filename, FileState(*state)) for (filename, state) in metadata["files"].items())
+
+    # Replays records from tokenize() into the ledger, can be called
+    # recursively through include.  Returns the bucket in effect at the
+    # end
+    def apply(self, records, filename=None, bucket=None):
+        if self.profile is not None:
+            records = self.profile.records(records, filename)
+
+        for record in records:
+            kind = record[0]
+            self.applied += 1
+
+            if kind == "transaction":
+                transaction, posts, endlinenum = record[1:]
+                if endlinenum is None:
+                    self.maketransaction(transaction,posts,bucket)
                 else:
                     try:
                         self.maketransaction(transaction, posts, bucket)
                     except Exception as e:
-                        e.args = (ParseError(filename, linenum, "Parse error: %s" % e),)
+                        e.args = (ParseError(filename, endlinenum, "Parse error: %s" % e),)
                         raise
 
-                    posts = []
-                    transaction = None
+            elif kind == "include":
+                self.parsefile(record[1])
 
-            if accountdef is not None:
-                # Ignore things under accountdef for now
-                m = re.match("^\s+(.*)$",line)
-                if m:
-                    continue
-                else:
-                    accountdef = None
+            elif kind == "bucket":
+                bucket = record[1]
 
-            m = re.match("(?P<date>\d{4}-\d{2}-\d{2})(=(?P<postdate>\d{4}-\d{2}-\d{2}))?\s+(?P<description>.*)", line)
-            if m:
-                if m.group("postdate") is not None:
-                    transaction = Transaction(m.group("postdate"),m.group("description"),filename,linenum)
-                else:
-                    transaction = Transaction(m.group("date"),m.group("description"),filename,linenum)
-                continue
-
-            m = re.match("commodity\s+(?P<commodity>.*)", line)
-            if m:
-                continue
-
-            m = re.match("account\s+(?P<account>.*)", line)
-            if m:
-                accountdef = m.groups()
-                continue
-
-            m = re.match("include\s+(?P<filename>.*)",line)
-            if m:
-                includefile = m.group("filename")
-                with open(includefile) as f:
-                    self.parse(f,includefile)
-                continue
+            elif kind == "print":
+                print record[1]
 
-            m = re.match("bucket\s+(?P<account>.*)",line)
-            if m:
-                bucket = m.group("account")
-                continue
+            elif kind == "alias":
+                self.symbols.alias(record[1], record[2])
 
-            m = re.match("print\s+(?P<str>.*)",line)
-            if m:
-                print m.group("str")
-                continue
+            elif kind == "price":
+                date, commodity, price = record[1:4]
+                self.prices.add(date, commodity, price.commodity, fixedvalue(price.value))
 
-            m = re.match("alias\s+(?P<alias>.*?)\s+(?P<account>.*)",line)
-            if m:
-                self.aliases[m.group("alias")] = m.group("account")
-                continue
+            elif kind == "closeall":
+                transaction, prefix, closingaccount = record[1:]
+                if self.lastdate is None or transaction.date > self.lastdate:
+                    self.lastdate = transaction.date
+                self.pending_closealls.append((transaction, prefix, closingaccount, filename))
 
-            m = re.match("closeall\s+(?P<asof>\d{4}-\d{2}-\d{2})\s+(?P<prefix>.+?)\s\s+(?P<closingaccount>.*)",line)
-            if m:
-                transaction = Transaction(m.group("asof"),"Automatic closing transaction",filename,linenum)
-                posts = []
-                closing = {}
-                for account in self.accounts:
-                    if account.startswith(m.group("prefix")):
-                        balance = self.balance(account,m.group("asof"))
-                        for commodity,value in balance.items():
-                            if commodity not in closing:
-                                closing[commodity] = decimal.Decimal(0)
-                            closing[commodity] += value
-                            posts.append(Post(account,Amount(commodity,-1*value),filename,linenum))
-
-                self.maketransaction(transaction, posts, m.group("closingaccount"))
-                transaction = None
-                posts = None
-                continue
-
-
-            m = re.match("assert\s+balance\s+(?P<asof>\d{4}-\d{2}-\d{2})?\s*(?P<account>.*?)\s\s+(?P<amount>.*)$",line)
-            if m:
-                if not self.assertions:
-                    continue
-                balance = self.balance_children(m.group("account"),m.group("asof"))
-                amount = self.parseamount(m.group("amount"),filename,linenum)
-
-                if not (amount.value == 0 and amount.commodity not in balance) and \
-                    (amount.commodity not in balance or balance[amount.commodity] != amount.value):
-                    raise AssertionError(filename, linenum, "Account %s actual balance of %s on %s does not match assertion value %s" % (m.group("account"),m.group("asof"), repr(balance), repr(amount)))
-
-                continue
-
-            m = re.match("assert\s+equation\s+(?P<asof>\d{4}-\d{2}-\d{2})?\s*(?P<assetsaccount>.*?)\s+-\s+(?P<liabilitiesaccount>.*?)\s+=\s+(?P<equityaccount>.*?)\s+\+\s+(?P<incomeaccount>.*?)\s+-\s+(?P<expenseaccount>.*?)$", line)
-            if m:
+            elif kind == "assert":
                 if not self.assertions:
                     continue
-                data = {}
-                for acct in ["assets","liabilities","equity","income","expense"]:
-                    balance = self.balance_children(m.group("%saccount" % acct),m.group("asof"))
-                    data[acct] = balance
-
-
-                # Assets + liabilities
-                left = {}
-                right = {}
-                for commodity in self.commodities:
-                    left[commodity] = decimal.Decimal(0)
-                    right[commodity] = decimal.Decimal(0)
-
-                    # Left
-                    if commodity in data["assets"]:
-                        left[commodity] += data["assets"][commodity]
-                    if commodity in data["liabilities"]:
-                        left[commodity] += data["liabilities"][commodity]
-
-                    # Right
-                    if commodity in data["equity"]:
-                        right[commodity] -= data["equity"][commodity]
-                    if commodity in data["income"]:
-                        right[commodity] -= data["income"][commodity]
-                    if commodity in data["expense"]:
-                        right[commodity] -= data["expense"][commodity]
-
+                assertkind, asof, accounts, amountstr, linenum = record[1:]
+                amount = None
+                if amountstr is not None:
+                    amount = self.parseamount(amountstr,filename,linenum)
+                self.assertion(Assertion(assertkind, asof, accounts, amount, filename, linenum))
 
+            elif kind == "error":
+                raise ParseError(*record[1:])
 
-                if left != right:
-                    print data
-                    raise AssertionError(filename, linenum, "Accounting equation not satisified: %s != %s" % (repr(left), repr(right)))
-
-                continue
-
-
-            raise ParseError(filename, linenum, "Don't know how to parse \"%s\"" % line)
-
-        if transaction is not None:
-            self.maketransaction(transaction,posts,bucket)
+        return bucket
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description=' some integers.')
     parser.add_argument('-f','--filename', required=True, help='filename to load')
-    parser.add_argument("command", default='balance', choices=['balance','register', 'web'])
+    parser.add_argument("command", default='balance', choices=['balance','register', 'web', 'serve', 'periodic', 'check'])
     parser.add_argument('-a','--account', help='Apply to which account')
     parser.add_argument('-s','--start', help='Start at which date')
     parser.add_argument('-e','--end', help='End at which date')
+    parser.add_argument('-d','--deferred', action='store_true', help='Check assertions after the whole journal is loaded')
+    parser.add_argument('-c','--cache', help='Cache tokenized journal files in this directory')
+    parser.add_argument('--snapshot', help='Start from this snapshot of the loaded journal, bringing it up to date, and save it again after loading (not used by check)')
+    parser.add_argument('-j','--jobs', type=int, help='Parse included files in this many processes')
+    parser.add_argument('--threads', action='store_true', help='Read included files in --jobs threads rather than processes, for slow storage')
+    parser.add_argument('--split', action='store_true', help='Write the web report as one page per year')
+    parser.add_argument('--currency', help='Also value balances in this commodity, using P prices')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to serve queries on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to serve queries on')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between checks for changed journal files when serving')
+    parser.add_argument('-p','--period', default='monthly', choices=sorted(PERIODS), help='Period length for periodic')
+    parser.add_argument('--deltas', action='store_true', help='Show how much periodic balances changed over each period')
+    parser.add_argument('--rollup', action='store_true', help='Include parent accounts in periodic, with the totals below them')
+    parser.add_argument('--changed', action='store_true', help='Only check assertions in files changed since the last check, or dated on or after the earliest transaction in a changed file')
+    parser.add_argument('--state', help='Where check records the files it has checked, written only with --state or --changed (default: the cache directory, or next to the journal)')
+    parser.add_argument('--profile', action='store_true', help='Print where parsing spent its time')
+    parser.add_argument('--profile-json', help='Write parse timings to this file as JSON')
 
     args = parser.parse_args()
 
+    profile = args.profile or args.profile_json is not None
     if args.command == "register":
-        ledger = Ledger(assertions=False)
+        ledger = Ledger(assertions=False, cache=args.cache, profile=profile)
+    elif args.command == "check":
+        ledger = Ledger(deferred=True, cache=args.cache, profile=profile)
     else:
-        ledger = Ledger()
-
+        ledger = Ledger(deferred=args.deferred, cache=args.cache, profile=profile)
+
+    # filename -> {"digest", "first": date of its earliest transaction,
+    # "passed": whether its assertions all passed} for each file checked
+    statefile = args.state
+    if statefile is None:
+        statefile = os.path.join(args.cache, "check.json") if args.cache else args.filename + ".check.json"
+    if args.changed and os.path.exists(statefile):
+        with open(statefile) as f:
+            checked = json.load(f)
+        for filename, state in checked.items():
+            if os.path.exists(filename) and filedigest(filename) == state["digest"]:
+                ledger.unchanged.add(filename)
+                if state["passed"]:
+                    ledger.unchecked.add(filename)
+            else:
+                first = state["first"] or "0000-00-00"
+                if ledger.changedfrom is None or first < ledger.changedfrom:
+                    ledger.changedfrom = first
+
+    # A snapshot is brought up to date with refresh(), which reloads if
+    # the files changed in any way but appended text.  It is only saved
+    # once every assertion has been checked
+    snapshot = args.snapshot if args.command != "check" else None
     try:
-        with open(args.filename) as f:
-            ledger.parse(f,args.filename)
+        loaded = False
+        if snapshot is not None and os.path.exists(snapshot):
+            try:
+                ledger.load_snapshot(snapshot)
+                loaded = ledger.root == args.filename
+            except SnapshotError:
+                pass
+        if loaded:
+            changed = ledger.refresh()
+        else:
+            ledger.reset()
+            ledger.load(args.filename, args.jobs, args.threads)
+            changed = True
+        if snapshot is not None and changed and ledger.assertions:
+            ledger.save_snapshot(snapshot)
     except AssertionError,e:
-        print e
-        sys.exit(1)
+        if args.command != "check":
+            print e
+            sys.exit(1)
     except ParseError,e:
         print e
         sys.exit(1)
+    finally:
+        if args.profile:
+            sys.stderr.write(ledger.profile.table())
+        if args.profile_json is not None:
+            with open(args.profile_json, "w") as f:
+                json.dump(ledger.profile.json(), f, indent=2, sort_keys=True)
 
     if args.command == "balance":
         accountkeys = ledger.accounts.keys()
@@ -380,14 +2146,20 @@ if __name__ == "__main__":
         for account in accountkeys:
             maxlen = max(maxlen,len(account))
 
+        columns = len(ledger.commodities)
         for commodity in ledger.commodities:
             print commodity.rjust(10," "),
+        if args.currency:
+            print ("= " + args.currency).rjust(10," "),
+            columns += 1
 
+        if args.start:
+            print "Changes from %s" % args.start
         if enddate:
             print "Balances asof %s" % enddate
         print "Account".ljust(maxlen+1," ")
-        print "-" * (maxlen+1 + len(ledger.commodities)*11)
-        balances = ledger.balances(enddate)
+        print "-" * (maxlen+1 + columns*11)
+        balances = ledger.balances(enddate, args.start)
         for account in accountkeys:
             b = balances[account]
             for i, commodity in enumerate(ledger.commodities):
@@ -395,51 +2167,45 @@ if __name__ == "__main__":
                     print str(b[commodity]).rjust(10," "),
                 else:
                     print "-".rjust(10," "),
+            if args.currency:
+                try:
+                    print str(ledger.value(b, args.currency, enddate)).rjust(10," "),
+                except PriceNotFoundError:
+                    print "-".rjust(10," "),
             print account
 
     elif args.command == "web":
         import web
-        web.make_report(ledger, ".")
+        web.make_report(ledger, ".", args.split, args.start, args.end, args.currency)
+
+    elif args.command == "serve":
+        import server
+        server.serve(ledger, args.host, args.port, args.interval)
+
+    elif args.command == "check":
+        for failure in ledger.failures:
+            print failure
+        failed = set(failure.filename for failure in ledger.failures)
+        if args.changed or args.state is not None:
+            first = ledger.firstdates()
+            checked = dict((filename, {"digest": state.digest, "first": first.get(filename), "passed": filename not in failed})
+                           for (filename, state) in ledger.files.items())
+            with open(statefile, "w") as f:
+                json.dump(checked, f, indent=2, sort_keys=True)
+        print "%d assertion(s) failed in %d file(s), %d file(s) skipped as unchanged" % (len(ledger.failures), len(failed), len(ledger.unchecked))
+        sys.exit(1 if ledger.failures else 0)
+
+    elif args.command == "periodic":
+        table = ledger.periodic(args.period, args.start, args.end, args.rollup)
+        print "\t".join(["Account", "Commodity"] + table.periods)
+        for account in sorted(table.balances):
+            if args.account is not None and account != args.account and not account.startswith(args.account + ":"):
+                continue
+            series = (table.deltas if args.deltas else table.balances)[account]
+            for commodity in sorted(series):
+                print "\t".join([account, commodity] + [str(value) for value in series[commodity]])
 
     elif args.command == "register":
-        accountkeys = ledger.accounts.keys()
-        accountkeys.sort()
-
-        firstdate = None
-        startdate = args.start
-        enddate = args.end
-        balances = {}
-        # If no start date, find the earliest/last as bounds
-        for account in ledger.accounts:
-            balances[account] = {}
-            datekeys = ledger.accounts[account].keys()
-            datekeys.sort()
-            if firstdate is None or datekeys[0] < firstdate:
-                firstdate = datekeys[0]
-            if args.end is None and (enddate is None or datekeys[-1] > enddate):
-                enddate = datekeys[-1]
-
-        if startdate is None:
-            startdate = firstdate
-
-        firstdate = datetime.datetime.strptime( firstdate, "%Y-%m-%d" )
-        startdate = datetime.datetime.strptime( startdate, "%Y-%m-%d" )
-        enddate = datetime.datetime.strptime( enddate, "%Y-%m-%d" )
-
-
-        while firstdate <= enddate:
-            today = firstdate.strftime("%Y-%m-%d")
-            for account in ledger.accounts:
-                if args.account is None or account.startswith(args.account):
-                    if today in ledger.accounts[account]:
-                        for transaction in ledger.accounts[account][today]:
-                            if transaction.amount.commodity not in balances[account]:
-                                balances[account][transaction.amount.commodity] = 0
-                            balances[account][transaction.amount.commodity] += transaction.amount.value
-
-                            if firstdate >= startdate:
-                                print today, str(balances[account][transaction.amount.commodity]).rjust(8," "), transaction.amount.commodity, str(transaction.amount.value).rjust(8," "), transaction.description
-                                if args.account is None or account.startswith(args.account):
-                                    print "\t",account
-
-            firstdate += datetime.timedelta(days=1)
+        for row in ledger.register(args.account, args.start, args.end):
+            print row.date, str(row.balance).rjust(8," "), row.commodity, str(row.value).rjust(8," "), row.description
+            print "\t",row.account
@@ -1,114 +1,244 @@
+import datetime
+import hashlib
+import json
 import os
 import shutil
 
-def make_category(f,org,category,balances,ledger,asof,positive):
+HEADER = """<!DOCTYPE html><html><head><title>Report</title>
+        <link href="http://fonts.googleapis.com/css?family=Raleway:400,300,600" rel="stylesheet" type="text/css">
+
+        <!-- CSS -->
+        <link rel="stylesheet" href="css/normalize.css">
+        <link rel="stylesheet" href="css/skeleton.css">
+
+
+        <style type='text/css'>
+        * { font-family: sans-serif; margin: 0; padding: 0;}
+        html { font-size: 50%; }
+        h3 { border-bottom: 3px solid black; background: black; color: white; }
+        h4 { border-bottom: 1px solid black; }
+        table { border-collapse: collapse; width: 100%}
+        td { vertical-align: top; }
+        td.subcat { padding-left: 1em; }
+        .total { text-align: right; white-space: nowrap; }
+        thead td { font-weight: bold; border-bottom: 2px solid black; padding-left: 1.25rem }
+        tfoot td { font-weight: bold; border-top: 3px double black;  padding-left: 1.25rem }
+        td { padding-top: 0.1rem; padding-bottom: 0.1rem; }
+        .category { float: left; padding: 1em; margin: 1em; width: 50% }
+        .year { page-break-after:always; }
+        </style></head><body>"""
+
+FOOTER = "</body></html>"
+
+# Records a fingerprint of each year's data, so split reports can skip
+# years that have not changed since the last run
+MANIFEST = "report.json"
+
+BUFFER_SIZE = 1 << 16
+
+positive = { "Expenses": True, "Assets":True, "Liabilities":False, "Income": False, "Equity":False }
+
+# balances holds every account's own balance and rollups every account
+# and parent account's total, both as of the report date.  The HTML is
+# appended to out as chunks for the caller to join.  value, if given,
+# turns a balance into (currency, Decimal) for a valued total, or None
+# if it can't be priced
+def make_category(out,org,category,balances,rollups,positive,value=None):
     accountnames = balances.keys()
     accountnames.sort()
-    f.write("<table>")
-    f.write("<thead><tr><td colspan='2'>%s</td></tr></thead>" % category)
-    f.write("<tbody>")
+    out.append("<table>")
+    out.append("<thead><tr><td colspan='2'>%s</td></tr></thead>" % category)
+    out.append("<tbody>")
     for account in [i[len(org+":"+category)+1:] for i in accountnames if (org+":"+category in i and org+":"+category != i)]:
         if len(balances[org+":"+category+":"+account]) == 0 or \
                 sum(balances[org+":"+category+":"+account].values()) == 0:
                     continue
 
-        f.write("<tr><td class='subcat'>%s</td><td class='total'>" % account)
+        out.append("<tr><td class='subcat'>%s</td><td class='total'>" % account)
         if len(balances[org+":"+category+":"+account]) == 0:
-            f.write("-")
+            out.append("-")
         else:
-            f.write("<br/>".join(
+            out.append("<br/>".join(
                 "%s %.2f" % (commodity, amount * (1 if positive else -1)) for (commodity,amount) in balances[org+":"+category+":"+account].items() if amount != 0
             ))
-        f.write("</tr>")
+        out.append("</tr>")
 
-    f.write("</tbody>")
-    f.write("<tfoot><tr><td>Total</td><td class='total'>")
-    if len(ledger.balance_children(org+":"+category,asof)) == 0:
-        f.write("-")
+    out.append("</tbody>")
+    out.append("<tfoot><tr><td>Total</td><td class='total'>")
+    total = rollups.get(org+":"+category, {})
+    if len(total) == 0:
+        out.append("-")
     else:
-        f.write("<br/>".join(
-            "%s %.2f" % (commodity, amount * (1 if positive else -1)) for (commodity,amount) in ledger.balance_children(org+":"+category,asof).items()
+        out.append("<br/>".join(
+            "%s %.2f" % (commodity, amount * (1 if positive else -1)) for (commodity,amount) in total.items()
         ))
-    f.write("</tr></tfoot>")
-    f.write("</table>")
-
-def make_report(ledger,destdir):
-
-    startdate = ledger.startdate()
-    enddate = ledger.enddate()
+    out.append("</tr>")
+    if value is not None:
+        valued = value(total)
+        out.append("<tr><td>Value</td><td class='total'>")
+        out.append("%s %.2f" % (valued[0], valued[1] * (1 if positive else -1)) if valued is not None else "-")
+        out.append("</tr>")
+    out.append("</tfoot>")
+    out.append("</table>")
+
+# Renders every org's section for one year as a single string.  asof is
+# the date the balances were taken on, if not the year end
+def make_year(year,orgs,balances,rollups,value=None,asof=None):
+    out = []
+    for org in orgs:
+        out.append("<div class='container year'>")
+        if asof is None or asof == "%d-12-31" % year:
+            out.append("<h4>%s EOY %d</h4>" % (org, year))
+        else:
+            out.append("<h4>%s as of %s</h4>" % (org, asof))
+        out.append("<div class='row'>")
+        for categories in [["Assets"],["Liabilities","Equity"]]:
+            out.append("<div class='six columns'>")
+            for category in categories:
+                make_category(out, org, category, balances, rollups, positive[category], value)
+            out.append("</div>")
+        out.append("</div>")
+
+        out.append("<div class='row'>")
+        for categories in [["Income"],["Expenses"]]:
+            out.append("<div class='six columns'>")
+            for category in categories:
+                make_category(out, org, category, balances, rollups, positive[category], value)
+            out.append("</div>")
+        out.append("</div>")
+
+
+        out.append("</div>")
+    return "".join(out)
+
+# Date each year's balances are taken on: its last day, or end for the
+# year end falls in
+def year_ends(firstyear, endyear, end=None):
+    result = dict((year, "%d-12-31" % year) for year in range(firstyear, endyear+1))
+    if end is not None and int(end[:4]) in result:
+        result[int(end[:4])] = end
+    return result
+
+# Flows are counted over a period rather than accumulated like balances
+def isflow(name):
+    return name.split(":")[1:2] in (["Income"], ["Expenses"])
+
+# Takes the balances and rollups of every account at each year end from
+# a single chronological sweep over the ledger, as of end in its year.
+# With start, Income and Expenses only count posts dated from start on
+def year_end_balances(ledger, firstyear, endyear, start=None, end=None):
+    asofs = year_ends(firstyear, endyear, end)
+    dates = asofs.values()
+    before = None
+    if start is not None:
+        before = (datetime.date(*map(int, start.split("-"))) - datetime.timedelta(days=1)).isoformat()
+        dates.append(before)
+
+    taken = {}
+    for asof, running, own in ledger.sweep(dates):
+        balances = dict((account, ledger.values(own.get(account, {}))) for account in ledger.accounts)
+        rollups = dict((prefix, ledger.values(total)) for (prefix, total) in running.items())
+        taken[asof] = (balances, rollups)
+
+    result = {}
+    for year, asof in asofs.items():
+        balances, rollups = taken[asof]
+        if before is not None:
+            for current, previous in zip((balances, rollups), taken[before]):
+                for name, balance in current.items():
+                    if isflow(name) and name in previous:
+                        current[name] = dict((commodity, balance.get(commodity, 0) - previous[name].get(commodity, 0))
+                                             for commodity in set(balance) | set(previous[name]))
+        result[year] = (balances, rollups)
+    return result
+
+# Values balances in currency at the prices as of asof, for make_year()
+def valuer(ledger, currency, asof):
+    def value(balance):
+        total = 0
+        for commodity, amount in balance.items():
+            if amount != 0:
+                price = ledger.prices.price(commodity, currency, asof)
+                if price is None:
+                    return None
+                total += amount * price
+        return currency, total
+    return value
+
+def fingerprint(orgs, balances, rollups, prices=None):
+    return hashlib.sha1(repr((sorted(orgs), sorted(balances.items()), sorted(rollups.items()), prices))).hexdigest()
+
+# Writes report.html, or with split=True one report-YYYY.html per year
+# plus a report.html index.  When splitting, years whose data matches
+# the last run's manifest are not rendered again.  start and end limit
+# the report to the years they fall in, the last year's balances are
+# taken as of end, and Income and Expenses only count posts from start
+# on.  With currency, each category total is also valued in that
+# currency at the prices as of each year's balances
+def make_report(ledger,destdir,split=False,start=None,end=None,currency=None):
+
+    startdate = start or ledger.startdate()
+    enddate = end or ledger.enddate()
 
     firstyear = startdate.split("-")[0]
     endyear = enddate.split("-")[0]
 
-    # Year by year
-
-    categories = ["Expenses","Assets","Liabilities","Income","Equity"]
-
-    positive = { "Expenses": True, "Assets":True, "Liabilities":False, "Income": False, "Equity":False }
-
     if not os.path.isdir(os.path.join(destdir,"css")):
         shutil.copytree(os.path.join(os.path.dirname(__file__), "css"), os.path.join(destdir,"css"))
 
-    with open(os.path.join(destdir,"report.html"),"w") as f:
-        f.write("<!DOCTYPE html>")
-        f.write("<html><head><title>Report</title>")
+    snapshots = year_end_balances(ledger, int(firstyear), int(endyear), start, end)
+    asofs = year_ends(int(firstyear), int(endyear), end)
+
+    orgs = set()
+    for account in ledger.accounts:
+        orgs.add(account.split(":")[0])
+
+    years = range(int(endyear),int(firstyear)-1,-1)
+
+    values = dict((year, valuer(ledger, currency, asofs[year]) if currency is not None else None) for year in years)
+
+    if not split:
+        with open(os.path.join(destdir,"report.html"),"w",BUFFER_SIZE) as f:
+            f.write(HEADER)
+            for year in years:
+                balances, rollups = snapshots[year]
+                f.write(make_year(year, orgs, balances, rollups, values[year], asofs[year]))
+            f.write(FOOTER)
+
+        print "Report written to %s" % os.path.join(destdir,"report.html")
+        return
+
+    manifest = {}
+    if os.path.exists(os.path.join(destdir,MANIFEST)):
+        with open(os.path.join(destdir,MANIFEST)) as f:
+            manifest = json.load(f)
+
+    written = 0
+    for year in years:
+        balances, rollups = snapshots[year]
+        filename = "report-%d.html" % year
+        prices = None
+        if currency is not None:
+            prices = (currency, sorted((c, ledger.prices.price(c, currency, asofs[year])) for c in ledger.commodities))
+        digest = fingerprint(orgs, balances, rollups, (asofs[year], prices))
+        if manifest.get(str(year)) == digest and os.path.exists(os.path.join(destdir,filename)):
+            continue
+
+        with open(os.path.join(destdir,filename),"w",BUFFER_SIZE) as f:
+            f.write(HEADER)
+            f.write(make_year(year, orgs, balances, rollups, values[year], asofs[year]))
+            f.write(FOOTER)
+        manifest[str(year)] = digest
+        written += 1
 
-        f.write("""
-        <link href="http://fonts.googleapis.com/css?family=Raleway:400,300,600" rel="stylesheet" type="text/css">
-
-        <!-- CSS -->
-        <link rel="stylesheet" href="css/normalize.css">
-        <link rel="stylesheet" href="css/skeleton.css">
+    with open(os.path.join(destdir,"report.html"),"w") as f:
+        f.write(HEADER)
+        f.write("<div class='container'><h4>Report</h4><ul>")
+        f.write("".join("<li><a href='report-%d.html'>%d</a></li>" % (year, year) for year in years))
+        f.write("</ul></div>")
+        f.write(FOOTER)
 
+    with open(os.path.join(destdir,MANIFEST),"w") as f:
+        json.dump(manifest, f)
 
-        <style type='text/css'>
-        * { font-family: sans-serif; margin: 0; padding: 0;}
-        html { font-size: 50%; }
-        h3 { border-bottom: 3px solid black; background: black; color: white; }
-        h4 { border-bottom: 1px solid black; }
-        table { border-collapse: collapse; width: 100%}
-        td { vertical-align: top; }
-        td.subcat { padding-left: 1em; }
-        .total { text-align: right; white-space: nowrap; }
-        thead td { font-weight: bold; border-bottom: 2px solid black; padding-left: 1.25rem }
-        tfoot td { font-weight: bold; border-top: 3px double black;  padding-left: 1.25rem }
-        td { padding-top: 0.1rem; padding-bottom: 0.1rem; }
-        .category { float: left; padding: 1em; margin: 1em; width: 50% }
-        .year { page-break-after:always; }
-        </style>""")
-        f.write("</head>");
-        f.write("<body>")
-
-        for year in range(int(endyear),int(firstyear)-1,-1):
-            asof = "%d-12-31" % year
-            balances = ledger.balances(asof)
-
-            orgs = set()
-            for account in balances.keys():
-                orgs.add(account.split(":")[0])
-
-            for org in orgs:
-                f.write("<div class='container year'>")
-                f.write("<h4>%s EOY %d</h4>" % (org, year))
-                f.write("<div class='row'>")
-                for categories in [["Assets"],["Liabilities","Equity"]]:
-                    f.write("<div class='six columns'>")
-                    for category in categories:
-                        make_category(f, org, category, balances, ledger, asof, positive[category])
-                    f.write("</div>")
-                f.write("</div>")
-
-                f.write("<div class='row'>")
-                for categories in [["Income"],["Expenses"]]:
-                    f.write("<div class='six columns'>")
-                    for category in categories:
-                        make_category(f, org, category, balances, ledger, asof, positive[category])
-                    f.write("</div>")
-                f.write("</div>")
-
-
-                f.write("</div>")
-        f.write("</body>")
-        f.write("</html>")
-
-    print "Report written to %s" % os.path.join(destdir,"report.html")
+    print "Report written to %s (%d of %d years updated)" % (os.path.join(destdir,"report.html"), written, len(years))